@@ -10,13 +10,37 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import argparse
+import csv
+import datetime
+import json
+import multiprocessing
+import operator
 import os
 import re
+import shutil
 import sys
+import zipfile
 
 from xml.etree import ElementTree
 from collections import Counter, OrderedDict
 
+try:
+    from configparser import ConfigParser
+except ImportError:
+    from ConfigParser import ConfigParser
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
 __version__ = '1.3'
 
 RECORD_FIELDS = OrderedDict((
@@ -64,10 +88,149 @@ FIELDS = {
     'Workout': WORKOUT_FIELDS,
 }
 
+# Records of category types, such as SleepAnalysis, whose values are
+# names (e.g. HKCategoryValueSleepAnalysisInBed) rather than numbers.
+CATEGORY_PREFIX = 'HKCategoryTypeIdentifier'
+CATEGORY_FIELDS = OrderedDict(
+    (field, 's' if field == 'value' else datatype)
+    for (field, datatype) in RECORD_FIELDS.items())
+
+# 'd' fields holding plain dates, rather than timestamps.
+DATE_ONLY_FIELDS = ('dateComponents',)
+
+# Field whose maximum, per kind, is the watermark for incremental runs.
+# ActivitySummary nodes are rewritten in full every run, as the summary
+# for the current day keeps changing (and there is one node per day).
+WATERMARK_FIELDS = {
+    'Record': 'creationDate',
+    'Workout': 'creationDate',
+}
+WATERMARK_FILE = 'watermarks.json'
+# Nodes are re-read when created up to this long before their watermark,
+# as a source that syncs late (a watch left off its charger, a phone out
+# of range) adds nodes created before nodes already extracted. The loads
+# merge on the identity of the rows, so nodes read twice are kept once.
+WATERMARK_LOOKBACK = datetime.timedelta(days=3)
+
+# String fields that repeat on (almost) every node, which can be written
+# as small integer codes, with the values in DICTIONARY_FILE.
+INTERNED_FIELDS = ('sourceName', 'sourceVersion', 'device', 'type', 'unit')
+DICTIONARY_FILE = 'dictionary.csv'
+
+# Section of an ini file (e.g. database.ini) listing the types to include
+# and/or exclude, comma-separated, as in
+#     [types]
+#     exclude = stepcount, flightsclimbed, activitysummary
+TYPES_SECTION = 'types'
+
+# Zone that parse_timestamps() converts timestamps to (None for UTC).
+LOCAL_TIMEZONE = 'America/New_York'
+OFFSET_RE = re.compile(r'^([+-])(\d\d)(\d\d)$')
+
+# How each table is grouped into <table>_grouped: by the database loader
+# (createGroupedTable in Apple Health Final) and in memory by group_frame().
+#     by:          the date column whose day puts a row in a group
+#     day:         the name of that day in the grouped table
+#     minute:      whether to group by the hour and minute of startDate too
+#     datetime:    the name, if any, for the day, hour and minute together
+#     measure:     'value', or 'hours' from startDate to endDate
+#     merge:       whether to merge the intervals that overlap or touch
+#                  within a day into sessions (see merge_intervals())
+#                  before measuring, so time recorded by several sources
+#                  (a phone and a watch) is only counted once
+#     aggregates:  (function, name) for each aggregate of the measure,
+#                  'sum' or 'avg', with {table} in the name replaced
+#     pivot:       (column, values, [(field, suffix)]): the sum of each
+#                  field for each value of column (every value present if
+#                  values is None), named by pivot_column()
+GROUPINGS = {
+    'sleepanalysis': {'by': 'TheDate', 'day': 'TheDate', 'measure': 'hours',
+                      'merge': True, 'aggregates': [('sum', 'sum')]},
+    'mindfulsession': {'by': 'TheDate', 'day': 'TheDate', 'measure': 'hours',
+                       'merge': True, 'aggregates': [('sum', 'sum')]},
+    'heartrate': {'by': 'creationDate', 'day': 'creationdate',
+                  'minute': True, 'datetime': 'creationdatetime'},
+    'activeenergyburned': {'by': 'creationDate', 'day': 'creationdate',
+                           'minute': True, 'datetime': 'creationdatetime'},
+    'stepcount': {'by': 'creationDate', 'day': 'creationdate',
+                  'minute': True, 'datetime': 'creationdatetime'},
+    'heartratevariabilitysdnn': {'by': 'creationDate', 'day': 'creationdate',
+                                 'minute': True},
+    'appleexercisetime': {'by': 'creationDate', 'day': 'creationdate'},
+    'dietarymolybdenum': {'by': 'creationDate', 'day': 'creationdate'},
+    'vo2max': {'by': 'creationDate', 'day': 'creationdate'},
+    'basalenergyburned': {'by': 'endDate', 'day': 'TheDate'},
+    'restingheartrate': {'by': 'endDate', 'day': 'TheDate'},
+    'workout': {'by': 'creationDate', 'day': 'creationdate', 'aggregates': [],
+                'pivot': ('workoutActivityType', None,
+                          [('duration', 'Duration'),
+                           ('totalEnergyBurned', 'EnergyBurned'),
+                           ('totalDistance', 'Distance')])},
+}
+GROUPING_DEFAULTS = {
+    'minute': False,
+    'datetime': None,
+    'measure': 'value',
+    'merge': False,
+    'aggregates': [('sum', '{table}_sum'), ('avg', '{table}_avg')],
+    'pivot': None,
+}
+
+# Hour from which sleep counts towards the next day's night.
+NIGHT_STARTS = 18
+
+# The columns the loader adds to some tables before they are grouped, and
+# the rows it keeps (DERIVED_COLUMNS and ROW_FILTERS in Apple Health
+# Final), as functions of a DataFrame from read_frame().
+FRAME_COLUMNS = {
+    'mindfulsession': [
+        ('TheDate', lambda frame: frame['endDate'].dt.normalize()),
+    ],
+    'sleepanalysis': [
+        ('Hour', lambda frame: frame['startDate'].dt.hour),
+        ('TheDate', lambda frame: frame['startDate'].where(
+            frame['startDate'].dt.hour < NIGHT_STARTS,
+            frame['startDate'] + pandas.Timedelta(days=1))),
+    ],
+}
+FRAME_FILTERS = {
+    'sleepanalysis': lambda frame: (frame['value']
+                                    == 'HKCategoryValueSleepAnalysisInBed'),
+}
+
+# Numeric record types kept as a rollup pyramid: for each level, a table
+# <table>_rollup_<level> (see rollup_table()) of the sum, count, min and
+# max of value per period of ROLLUP_BY, as (level, the level below it,
+# from which it is built; None: from the rows themselves). Months are
+# built from days, as weeks straddle them.
+ROLLUPS = ('heartrate', 'restingheartrate', 'walkingheartrateaverage',
+           'heartratevariabilitysdnn', 'activeenergyburned',
+           'basalenergyburned')
+ROLLUP_BY = 'startDate'
+ROLLUP_LEVELS = (('minute', None), ('hour', 'minute'), ('day', 'hour'),
+                 ('week', 'day'), ('month', 'day'))
+
+
+EXPORT_MEMBER = 'apple_health_export/export.xml'
+EXPORT_MEMBER_RE = re.compile(r'(^|/)export\.xml$')
+
+ROOT_RE = re.compile(br'<HealthData[\s>]')
+BOUNDARY_RE = re.compile(br'<(?:Record|Workout|ActivitySummary)[\s/>]')
+CORRELATION_OPEN = b'<Correlation'
+CORRELATION_CLOSE = b'</Correlation>'
+BLOCK_SIZE = 1 << 20
+MIN_CHUNK_SIZE = 1 << 20
+CHUNKS_PER_PROCESS = 4
+PARQUET_BATCH_SIZE = 100000
+CSV_BATCH_SIZE = 10000
+STRING_CACHE_SIZE = 100000
 
 PREFIX_RE = re.compile('^HK.*TypeIdentifier(.+)$')
 ABBREVIATE = True
 VERBOSE = True
+STREAMING = False
+PROCESSES = 1
+OUTPUT_FORMAT = 'csv'
 
 def format_freqs(counter):
     """
@@ -98,6 +261,508 @@ def format_value(value, datatype):
         raise KeyError('Unexpected format value: %s' % datatype)
 
 
+class RowTemplates(dict):
+    """
+    Cache of CSV line templates for one field spec, keyed by the values
+    of its string (and coded) fields, in order. Each template has those
+    fields already formatted, by format_value() or as their codes, and
+    '%s' for the others, so that the values repeated on every node
+    (sourceName, device, type, unit, ...) are only escaped once per
+    combination. Stops caching new templates once it holds
+    STRING_CACHE_SIZE of them.
+    """
+    def __init__(self, fields, strings, codes):
+        dict.__init__(self)
+        self.fields = fields
+        self.strings = strings
+        self.codes = codes
+
+    def __missing__(self, key):
+        formatted = {}
+        for (field, value) in zip(self.strings, key):
+            if field in self.codes:
+                text = self.codes[field][value]
+            else:
+                text = format_value(value, 's')
+            formatted[field] = text.replace('%', '%%')
+        template = ','.join([formatted.get(field, '%s')
+                             for field in self.fields]) + '\n'
+        if len(self) < STRING_CACHE_SIZE:
+            self[key] = template
+        return template
+
+
+class Codes(dict):
+    """
+    Small integer codes (as strings, ready to write) for the values of
+    one field, assigned in order of first appearance after any values
+    given initially. Each distinct value is held once, in self.values,
+    whose indexes are the codes. None maps to empty.
+    """
+    def __init__(self, values=()):
+        dict.__init__(self, ((None, ''),))
+        self.values = []
+        for value in values:
+            self[value]
+
+    def __missing__(self, value):
+        code = self[value] = '%d' % len(self.values)
+        self.values.append(value)
+        return code
+
+
+def load_dictionary(directory):
+    """
+    Read the values of the coded fields from the dictionary written in
+    directory by the last run with codes, as a dict mapping each field
+    to a list of its values in code order (empty if there is none).
+    """
+    path = os.path.join(directory, DICTIONARY_FILE)
+    dictionary = dict((field, []) for field in INTERNED_FIELDS)
+    if not os.path.exists(path):
+        return dictionary
+    with open(path) as f:
+        reader = csv.reader(f, escapechar='\\', doublequote=False)
+        next(reader)
+        for (field, code, value) in reader:
+            dictionary[field].append(value)
+    return dictionary
+
+
+def save_dictionary(directory, codes):
+    """
+    Write the values for each field in codes (field -> Codes) to the
+    dictionary file in directory, one field,code,value line per value.
+    """
+    path = os.path.join(directory, DICTIONARY_FILE)
+    with open(path, 'w') as f:
+        f.write('field,code,value\n')
+        for (field, values) in codes.items():
+            f.write(encode(''.join('%s,%d,%s\n' % (format_value(field, 's'),
+                                                   code,
+                                                   format_value(value, 's'))
+                                   for (code, value)
+                                   in enumerate(values.values))))
+    return path
+
+
+def make_recoder(fields, mappings):
+    """
+    Build a function that rewrites the codes in a CSV line written
+    with codes, using mappings (field -> list mapping each old code to
+    a new one), or return None if all the mappings are identities.
+
+    The coded fields must come first in fields, as they do in the
+    Record and Workout specs, so that they can be split off the line.
+    """
+    coded = [field in mappings for field in fields]
+    n = coded.index(False) if False in coded else len(coded)
+    if any(coded[n:]):
+        raise ValueError('Coded fields must precede all others')
+    maps = [mappings[field] for field in list(fields)[:n]]
+    if all(m == ['%d' % i for i in range(len(m))] for m in maps):
+        return None
+
+    def recode(line):
+        values = line.split(',', n)
+        for (i, m) in enumerate(maps):
+            if values[i]:
+                values[i] = m[int(values[i])]
+        return ','.join(values)
+    return recode
+
+
+def tuple_getter(names):
+    """
+    operator.itemgetter(*names), except that the function returned
+    always returns a tuple, even for one name (or none).
+    """
+    if len(names) == 1:
+        get = operator.itemgetter(names[0])
+        return lambda mapping: (get(mapping),)
+    elif not names:
+        return lambda mapping: ()
+    return operator.itemgetter(*names)
+
+
+def make_row_encoder(fields, codes=None):
+    """
+    Build a function that formats a node's attributes as a CSV line,
+    with the columns given by fields (e.g. RECORD_FIELDS), producing
+    the same output as applying format_value() to each field, except
+    that fields in codes (field -> Codes) are written as their codes.
+
+    The function picks out the string (and coded) fields and the rest
+    with two itemgetters, and formats the rest into the RowTemplates
+    template for the string values, so there are no per-field spec
+    lookups, datatype dispatch or string escaping on each node. Nodes
+    missing any of the fields (such as the value of a MindfulSession)
+    use attributes.get() instead.
+    """
+    codes = codes or {}
+    for datatype in fields.values():
+        if datatype not in ('s', 'n', 'd'):
+            raise KeyError('Unexpected format value: %s' % datatype)
+    strings = [field for (field, datatype) in fields.items()
+               if datatype == 's' or field in codes]
+    others = [field for field in fields if field not in strings]
+    get_strings = tuple_getter(strings)
+    get_others = tuple_getter(others)
+    blanks = ('',) * len(others)
+    templates = RowTemplates(list(fields), strings, codes)
+    n_fields = len(fields)
+
+    def encode_row(attributes):
+        if len(attributes) >= n_fields:
+            try:
+                return (templates[get_strings(attributes)]
+                        % get_others(attributes))
+            except KeyError:
+                pass
+        get = attributes.get
+        return (templates[tuple(map(get, strings))]
+                % tuple(map(get, others, blanks)))
+    return encode_row
+
+
+def parse_date(value):
+    """
+    Parse a date from export.xml.
+
+    Timestamps, such as '2019-07-01 22:30:00 -0400', map to naive UTC
+    datetimes (here 2019-07-02 02:30:00); plain dates, such as the
+    dateComponents of an ActivitySummary, '2019-07-01', map to dates.
+    None maps to None.
+    """
+    if value is None:
+        return None
+    if len(value) == 10:
+        return datetime.date(int(value[:4]), int(value[5:7]),
+                             int(value[8:10]))
+    t = datetime.datetime(int(value[:4]), int(value[5:7]), int(value[8:10]),
+                          int(value[11:13]), int(value[14:16]),
+                          int(value[17:19]))
+    offset = int(value[21:23]) * 60 + int(value[23:25])
+    return t - datetime.timedelta(minutes=offset if value[20] == '+'
+                                          else -offset)
+
+
+def parse_offset(offset):
+    """
+    Parse a UTC offset, such as '-0400', as a pandas.Timedelta.
+    """
+    match = OFFSET_RE.match(offset)
+    if match is None:
+        raise ValueError('Unexpected UTC offset: %s' % offset)
+    delta = pandas.Timedelta(hours=int(match.group(2)),
+                             minutes=int(match.group(3)))
+    return delta if match.group(1) == '+' else -delta
+
+
+def parse_timestamps(values, timezone=LOCAL_TIMEZONE):
+    """
+    Parse a pandas Series of dates from export.xml (or the CSV files),
+    as parse_date() does for one, but a column at a time.
+
+    Timestamps, with any offset, are normalised to UTC and then
+    converted to timezone (unless it is None), giving naive datetimes;
+    plain dates (dateComponents) are parsed as midnight. Blanks map to
+    NaT.
+
+    The text is split into its local time and offset, and each distinct
+    offset (there are only a handful) is parsed once, which is much
+    faster than to_datetime() with %z.
+    """
+    values = values.astype(object).where(values.notnull(), None)
+    present = values.dropna()
+    if len(present) == 0 or len(present.iloc[0]) == 10:
+        return pandas.to_datetime(values, format='%Y-%m-%d')
+    times = pandas.to_datetime(values.str.slice(0, 19),
+                               format='%Y-%m-%d %H:%M:%S')
+    offsets = values.str.slice(20)
+    deltas = dict((offset, parse_offset(offset))
+                  for offset in offsets.dropna().unique())
+    times = (times - offsets.map(deltas)).dt.tz_localize('UTC')
+    if timezone is not None:
+        times = times.dt.tz_convert(timezone)
+    return times.dt.tz_localize(None)
+
+
+def name_fields(name):
+    """
+    The fields (FIELDS entry) of the CSV file or table name, such as
+    'HeartRate.csv', 'heartrate' or 'workout'.
+    """
+    name = os.path.basename(name).replace('.csv', '').lower()
+    for kind in FIELDS:
+        if kind != 'Record' and kind.lower() == name:
+            return FIELDS[kind]
+    return RECORD_FIELDS
+
+
+def date_fields(name):
+    """
+    Names of the date ('d') fields of the CSV file or table name, such
+    as 'HeartRate.csv', 'heartrate' or 'workout'.
+    """
+    return [field for (field, datatype) in name_fields(name).items()
+            if datatype == 'd']
+
+
+def grouping_spec(table):
+    """
+    The GROUPINGS entry for table, with GROUPING_DEFAULTS filled in, or
+    None if the table isn't grouped.
+    """
+    if table not in GROUPINGS:
+        return None
+    spec = dict(GROUPING_DEFAULTS)
+    spec.update(GROUPINGS[table])
+    return spec
+
+
+def pivot_column(value, suffix):
+    """
+    The name of the pivoted column for value, such as
+    'hkworkoutactivitytypeyogaduration': value + suffix, lower case and
+    cut to 63 characters, as PostgreSQL would.
+    """
+    return (value + suffix).lower()[:63]
+
+
+def rollup_table(table, level):
+    """
+    The name of the table holding level of the rollup pyramid of table,
+    such as 'heartrate_rollup_hour'.
+    """
+    return '%s_rollup_%s' % (table, level)
+
+
+def rollup_periods(values, level):
+    """
+    The start of the period of level (see ROLLUP_LEVELS) holding each of
+    values, a Series of datetimes, as PostgreSQL's date_trunc() gives it:
+    weeks start on Monday.
+    """
+    if level in ('week', 'month'):
+        return values.dt.to_period(level[0].upper()).dt.start_time
+    return values.dt.floor(pandas.Timedelta(**{level + 's': 1}))
+
+
+def read_frame(path, timezone=LOCAL_TIMEZONE):
+    """
+    Read a CSV or Parquet file written by HealthDataExtractor as a
+    pandas DataFrame typed as the database loader types its table:
+    dates as naive local times in timezone (see parse_timestamps),
+    numbers as floats and strings (such as a sourceVersion of '6.10')
+    as objects. Plain dates (dateComponents) become midnight.
+    """
+    if pandas is None:
+        raise ImportError('Reading extracted files requires pandas')
+    name = os.path.basename(path).split('.')[0]
+    dates = date_fields(name)
+    if path.endswith('.parquet'):
+        frame = pyarrow.parquet.read_table(path).to_pandas()
+        for (field, values) in frame.items():
+            if str(values.dtype) == 'category':
+                frame[field] = values.astype(object)
+            elif (field in dates
+                  and isinstance(values.dtype, pandas.DatetimeTZDtype)):
+                values = values.dt.tz_convert(timezone or 'UTC')
+                frame[field] = values.dt.tz_localize(None)
+            elif field in dates:
+                # date32 (dateComponents) comes back as date objects
+                frame[field] = pandas.to_datetime(values)
+        return frame
+    text = [field for (field, datatype) in name_fields(name).items()
+            if datatype in ('d', 's')]
+    frame = pandas.read_csv(path, escapechar='\\',
+                            dtype=dict((field, object) for field in text))
+    for field in dates:
+        if field in frame:
+            frame[field] = parse_timestamps(frame[field], timezone)
+    return frame
+
+
+def merge_intervals(frame, by='TheDate'):
+    """
+    The sessions in frame: its intervals, from startDate to endDate,
+    merged wherever they overlap or touch on the same day of by (a
+    night, for sleep), as a DataFrame of by (that day), startDate and
+    endDate.
+
+    The intervals are sorted by day and start, then swept in one pass:
+    an interval starts a new session unless it starts no later than the
+    latest end of those before it that day.
+    """
+    intervals = pandas.DataFrame({by: frame[by].dt.normalize(),
+                                  'startDate': frame['startDate'],
+                                  'endDate': frame['endDate']})
+    intervals = intervals.dropna(subset=['startDate', 'endDate'])
+    intervals = intervals.sort_values([by, 'startDate', 'endDate'])
+    days = intervals.groupby(by, dropna=False)
+    latest = days['endDate'].cummax().groupby(intervals[by],
+                                              dropna=False).shift()
+    starts = latest.isnull() | (intervals['startDate'] > latest)
+    sessions = intervals.groupby(starts.cumsum()).agg(
+        {by: 'first', 'startDate': 'min', 'endDate': 'max'})
+    return sessions.reset_index(drop=True)
+
+
+def group_frame(table, frame):
+    """
+    Group frame, the rows of table (as from read_frame()), as GROUPINGS
+    says, giving the same rows and columns as <table>_grouped in the
+    database. Each aggregate is a single vectorised group-by over the
+    whole frame.
+    """
+    spec = grouping_spec(table)
+    frame = frame.copy()
+    for (column, derive) in FRAME_COLUMNS.get(table, []):
+        frame[column] = derive(frame)
+    if table in FRAME_FILTERS:
+        frame = frame[FRAME_FILTERS[table](frame)]
+    if spec['merge']:
+        frame = merge_intervals(frame, spec['by'])
+    day = spec['day']
+    keys = pandas.DataFrame({day: frame[spec['by']].dt.normalize()})
+    if spec['minute']:
+        keys['hour'] = frame['startDate'].dt.hour
+        keys['minute'] = frame['startDate'].dt.minute
+    groupers = [keys[key] for key in keys]
+    grouped = pandas.DataFrame(
+        index=keys.groupby(groupers, dropna=False).size().index)
+    if spec['measure'] == 'hours':
+        measure = ((frame['endDate'] - frame['startDate']).dt.total_seconds()
+                   / 3600)
+    elif spec['aggregates']:
+        measure = pandas.to_numeric(frame[spec['measure']], errors='coerce')
+    if spec['aggregates']:
+        groups = measure.groupby(groupers, dropna=False)
+    aggregates = []
+    for (function, name) in spec['aggregates']:
+        aggregates.append(name.format(table=table))
+        grouped[aggregates[-1]] = (groups.sum(min_count=1)
+                                   if function == 'sum' else groups.mean())
+    if spec['pivot']:
+        (column, values, fields) = spec['pivot']
+        sums = frame[[field for (field, suffix) in fields]].groupby(
+            groupers + [frame[column]], dropna=False).sum(min_count=1)
+        sums = sums.unstack(column)
+        if values is None:
+            values = sorted(set(value for (field, value) in sums.columns
+                                if not pandas.isnull(value)))
+        pivoted = OrderedDict()
+        for value in values:
+            for (field, suffix) in fields:
+                pivoted[pivot_column(value, suffix)] = (
+                    sums[(field, value)] if (field, value) in sums
+                    else float('nan'))
+        grouped = pandas.concat(
+            [grouped, pandas.DataFrame(pivoted, index=grouped.index)], axis=1)
+    pivots = [name for name in grouped.columns if name not in aggregates]
+    grouped = grouped.reset_index()
+    columns = aggregates + list(keys)
+    if spec['datetime']:
+        grouped[spec['datetime']] = (
+            grouped[day] + pandas.to_timedelta(grouped['hour'], unit='h')
+            + pandas.to_timedelta(grouped['minute'], unit='m'))
+        columns.append(spec['datetime'])
+    for key in ('hour', 'minute') if spec['minute'] else ():
+        grouped[key] = grouped[key].map(
+            lambda v: None if pandas.isnull(v) else str(int(v)))
+    grouped[day] = grouped[day].dt.date
+    return grouped[columns + pivots]
+
+
+def rollup_frames(frame):
+    """
+    The rollup pyramid of frame, the rows of a table in ROLLUPS (as from
+    read_frame()), as an OrderedDict of each level to a DataFrame of
+    period, sum, count, min and max, giving the same rows as the tables
+    in the database. Each level is grouped from the one below it.
+    """
+    frame = frame[frame[ROLLUP_BY].notnull()]
+    values = pandas.to_numeric(frame['value'], errors='coerce')
+    rows = pandas.DataFrame({'period': frame[ROLLUP_BY], 'sum': values,
+                             'count': values.notnull().astype(int),
+                             'min': values, 'max': values})
+    levels = OrderedDict()
+    for (level, below) in ROLLUP_LEVELS:
+        source = rows if below is None else levels[below]
+        groups = source.groupby(rollup_periods(source['period'], level))
+        rolled = pandas.DataFrame(OrderedDict((
+            ('sum', groups['sum'].sum(min_count=1)),
+            ('count', groups['count'].sum()),
+            ('min', groups['min'].min()),
+            ('max', groups['max'].max()))))
+        rolled.index.name = 'period'
+        levels[level] = rolled.reset_index()
+    return levels
+
+
+def group_files(directory, timezone=LOCAL_TIMEZONE):
+    """
+    Group each file extracted to directory whose table is in GROUPINGS,
+    with group_frame(), and write the result to the grouped directory
+    within it as grouped_<type>.csv, as the database does but with no
+    database. Returns the paths written.
+    """
+    out_dir = os.path.join(directory, 'grouped')
+    paths = []
+    for name in sorted(os.listdir(directory)):
+        (table, extension) = os.path.splitext(name)
+        if (extension not in ('.csv', '.parquet')
+                or grouping_spec(table.lower()) is None):
+            continue
+        frame = read_frame(os.path.join(directory, name), timezone)
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        paths.append(os.path.join(out_dir, 'grouped_%s.csv' % table))
+        group_frame(table.lower(), frame).to_csv(paths[-1], index=False)
+    return paths
+
+
+def format_date(value):
+    """
+    Format a naive UTC datetime as a UTC date in export.xml's format,
+    which parse_date() maps back to the same datetime.
+    """
+    return value.strftime('%Y-%m-%d %H:%M:%S +0000')
+
+
+def load_watermarks(directory):
+    """
+    Read the watermarks (kind -> naive UTC datetime) saved in directory
+    by the last incremental run, or an empty dict if there are none.
+    """
+    path = os.path.join(directory, WATERMARK_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return dict((kind, parse_date(value))
+                    for (kind, value) in json.load(f).items())
+
+
+def save_watermarks(directory, watermarks):
+    path = os.path.join(directory, WATERMARK_FILE)
+    with open(path, 'w') as f:
+        json.dump(dict((kind, format_date(value))
+                       for (kind, value) in watermarks.items()),
+                  f, indent=4, sort_keys=True)
+
+
+def parse_number(value):
+    """
+    Parse a numeric value, mapping None (and anything that isn't a
+    number) to None.
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
 def abbreviate(s, enabled=ABBREVIATE):
     """
     Abbreviate particularly verbose strings based on a regular expression
@@ -116,52 +781,639 @@ def encode(s):
 
 
 
+def type_name(kind):
+    """
+    Normalise a record type or kind for matching against include and
+    exclude lists: 'HKQuantityTypeIdentifierStepCount', 'StepCount' and
+    'stepcount' all map to 'stepcount' (which is also its table name).
+    """
+    return abbreviate(kind, True).lower()
+
+
+def split_names(names):
+    """
+    Split comma-separated names (or each of a list of them) into a list.
+    """
+    if isinstance(names, (list, tuple, set, frozenset)):
+        names = ','.join(names)
+    return [name.strip() for name in names.split(',') if name.strip()]
+
+
+def read_type_filter(filename, section=TYPES_SECTION, include=None,
+                     exclude=()):
+    """
+    Read the include and exclude lists of types from section of the
+    ini file filename, returning (include, exclude). A list that isn't
+    given there takes the default passed in (None for include means
+    all types).
+    """
+    parser = ConfigParser()
+    parser.read(filename)
+    if parser.has_section(section):
+        if parser.has_option(section, 'include'):
+            include = split_names(parser.get(section, 'include'))
+        if parser.has_option(section, 'exclude'):
+            exclude = split_names(parser.get(section, 'exclude'))
+    return (include, list(exclude))
+
+
+class TypeFilter(object):
+    """
+    Decide whether to keep the nodes of a kind (a Record type, or
+    Workout or ActivitySummary): kept if it is in include (or include is
+    None) and not in exclude, both compared with type_name(). Decisions
+    are cached, keyed on the type exactly as it appears in export.xml.
+    """
+    def __init__(self, include=None, exclude=()):
+        self.include = (None if include is None
+                        else set(type_name(k) for k in include))
+        self.exclude = set(type_name(k) for k in exclude)
+        self.decisions = {}
+
+    def __call__(self, kind):
+        try:
+            return self.decisions[kind]
+        except KeyError:
+            name = type_name(kind)
+            keep = ((self.include is None or name in self.include)
+                    and name not in self.exclude)
+            self.decisions[kind] = keep
+            return keep
+
+
+def find_export_member(archive, member=EXPORT_MEMBER):
+    """
+    Return the name of the export.xml member in an open ZipFile,
+    preferring member and otherwise taking the first member
+    called export.xml in any folder.
+    """
+    names = archive.namelist()
+    if member in names:
+        return member
+    for name in names:
+        if EXPORT_MEMBER_RE.search(name):
+            return name
+    raise KeyError('There is no export.xml in %s' % archive.filename)
+
+
+def open_export(path, member=EXPORT_MEMBER):
+    """
+    Open export.xml for reading as bytes.
+
+    path may be the export.xml itself, the export.zip produced by the
+    Health app (in which case member is decompressed on the fly, without
+    extracting anything to disk) or an already open binary stream, such
+    as a ZipFile member, which is returned unchanged (and is left for
+    the caller to close). A stream can only be read once, so in
+    streaming mode call extract() before report_stats().
+    """
+    if hasattr(path, 'read'):
+        return path
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            return archive.open(find_export_member(archive, member))
+    return open(path, 'rb')
+
+
+def find_body(f):
+    """
+    Return the byte offsets (start, end) of the content of the
+    <HealthData> root element of the export.xml open as f.
+    """
+    head = b''
+    m = None
+    while m is None or head.find(b'>', m.end() - 1) == -1:
+        block = f.read(BLOCK_SIZE)
+        if not block:
+            raise ValueError('No <HealthData> element found')
+        head += block
+        m = ROOT_RE.search(head)
+    start = head.find(b'>', m.end() - 1) + 1
+    f.seek(0, 2)
+    size = f.tell()
+    f.seek(max(0, size - BLOCK_SIZE))
+    tail = f.read()
+    end = size - len(tail) + tail.rfind(b'</HealthData>')
+    return start, end
+
+
+def align_to_node(f, pos, end):
+    """
+    Return the offset of the first top-level Record, Workout or
+    ActivitySummary at or after pos (or end if there is none), skipping
+    the Records nested inside Correlation elements.
+    """
+    while pos < end:
+        f.seek(pos)
+        block = f.read(min(BLOCK_SIZE, end - pos))
+        m = BOUNDARY_RE.search(block)
+        if m is None:
+            pos += max(1, len(block) - 32)
+            continue
+        candidate = pos + m.start()
+        f.seek(max(0, candidate - BLOCK_SIZE))
+        before = f.read(candidate - max(0, candidate - BLOCK_SIZE))
+        if before.rfind(CORRELATION_OPEN) > before.rfind(CORRELATION_CLOSE):
+            f.seek(candidate)
+            rest = f.read(min(BLOCK_SIZE, end - candidate))
+            close = rest.find(CORRELATION_CLOSE)
+            pos = (candidate + close if close != -1
+                   else candidate + max(1, len(rest) - 32))
+            continue
+        return candidate
+    return end
+
+
+def find_chunks(path, n_chunks):
+    """
+    Split the body of export.xml into (up to) n_chunks byte ranges
+    (start, end), each beginning at a top-level Record, Workout or
+    ActivitySummary, so that every range can be parsed on its own.
+    """
+    with open(path, 'rb') as f:
+        start, end = find_body(f)
+        n_chunks = max(1, min(n_chunks, (end - start) // MIN_CHUNK_SIZE))
+        size = (end - start) // n_chunks
+        offsets = [start]
+        for i in range(1, n_chunks):
+            offset = align_to_node(f, start + i * size, end)
+            if offset > offsets[-1]:
+                offsets.append(offset)
+        offsets.append(end)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+class ByteRange(object):
+    """
+    Read-only binary stream over bytes start:end of export.xml, wrapped
+    in a <HealthData> element so that the slice parses as a document.
+    """
+    def __init__(self, path, start, end):
+        self.name = '%s[%d:%d]' % (path, start, end)
+        self.f = open(path, 'rb')
+        self.f.seek(start)
+        self.remaining = end - start
+        self.head = b'<HealthData>'
+        self.tail = b'</HealthData>'
+
+    def read(self, size=-1):
+        if self.head:
+            (data, self.head) = (self.head, b'')
+            return data
+        if self.remaining > 0:
+            n = self.remaining if size < 0 else min(size, self.remaining)
+            data = self.f.read(n)
+            self.remaining = self.remaining - len(data) if data else 0
+            if data:
+                return data
+        (data, self.tail) = (self.tail, b'')
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+def extract_chunk(args):
+    """
+    Worker for parallel extraction: process one byte range of
+    export.xml, writing its CSV files to a directory of its own,
+    and return the counters for merging.
+    """
+    (path, start, end, directory, write, options) = args
+    f = ByteRange(path, start, end)
+    try:
+        data = HealthDataExtractor(f, verbose=False, streaming=True,
+                                   directory=directory, **options)
+        if write:
+            data.extract()
+        else:
+            data.collect_stats()
+    finally:
+        f.close()
+    return (data.n_nodes, data.tags, data.fields, data.record_types,
+            data.other_types, data.new_records, data.watermarks, data.skipped,
+            data.unparsed,
+            dict((field, values.values)
+                 for (field, values) in (data.codes or {}).items()))
+
+
+class CSVWriter(object):
+    """
+    Write the nodes of one kind to a CSV file, one line per node,
+    with the columns given by fields (e.g. RECORD_FIELDS).
+
+    Lines are formatted by an encoder built for the field spec by
+    make_row_encoder() and written CSV_BATCH_SIZE lines at a time.
+    Fields in codes (field -> Codes) are written as integer codes.
+    """
+    extension = 'csv'
+
+    def __init__(self, path, fields, codes=None):
+        self.path = path
+        self.fields = fields
+        self.encode_row = make_row_encoder(fields, codes)
+        self.lines = []
+        self.f = open(path, 'w')
+        self.f.write(','.join(fields.keys()) + '\n')
+
+    def write(self, attributes):
+        lines = self.lines
+        lines.append(self.encode_row(attributes))
+        if len(lines) >= CSV_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.f.write(encode(''.join(self.lines)))
+        self.lines = []
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+    @staticmethod
+    def concatenate(paths, out_path, recoders=None):
+        """
+        Write the CSV files in paths to out_path, one after another,
+        keeping only the header line of the first. recoders, if given,
+        has a function from make_recoder() (or None) for each path.
+        """
+        recoders = recoders or [None] * len(paths)
+        with open(out_path, 'wb') as out:
+            for (i, (path, recode)) in enumerate(zip(paths, recoders)):
+                with open(path, 'rb') as f:
+                    header = f.readline()
+                    if i == 0:
+                        out.write(header)
+                    if recode is None:
+                        shutil.copyfileobj(f, out, BLOCK_SIZE)
+                    else:
+                        for line in f:
+                            out.write(recode(line.decode('UTF-8'))
+                                      .encode('UTF-8'))
+
+
+class ParquetWriter(object):
+    """
+    Write the nodes of one kind to a Parquet file with typed columns,
+    driven by the datatype codes in fields:
+
+        's' strings, dictionary-encoded
+        'n' float64 (category kinds, such as SleepAnalysis, are given
+            CATEGORY_FIELDS, whose value is a string)
+        'd' UTC timestamps (or dates, for dateComponents)
+
+    Rows are buffered and written as a row group every
+    PARQUET_BATCH_SIZE nodes. The column types come from fields alone,
+    so every file (and every chunk of a parallel run) of a kind has the
+    same schema; values of 'n' fields that aren't numbers are written
+    as nulls, and counted, per field, in self.unparsed. Requires pyarrow. As
+    strings are already dictionary-encoded, codes are ignored.
+    """
+    extension = 'parquet'
+
+    def __init__(self, path, fields, codes=None):
+        if pyarrow is None:
+            raise ImportError('Parquet output requires pyarrow')
+        self.path = path
+        self.fields = fields
+        self.columns = [[] for field in fields]
+        self.types = [('D' if field in DATE_ONLY_FIELDS and datatype == 'd'
+                       else datatype)
+                      for (field, datatype) in fields.items()]
+        self.unparsed = Counter()
+        self.writer = None
+
+    def write(self, attributes):
+        for (column, field) in zip(self.columns, self.fields):
+            column.append(attributes.get(field))
+        if len(self.columns[0]) >= PARQUET_BATCH_SIZE:
+            self.flush()
+
+    def to_array(self, values, datatype):
+        if datatype == 's':
+            return pyarrow.array(values, pyarrow.string()).dictionary_encode()
+        elif datatype == 'n':
+            return pyarrow.array([parse_number(v) for v in values],
+                                 pyarrow.float64())
+        elif datatype == 'D':
+            return pyarrow.array([parse_date(v) for v in values],
+                                 pyarrow.date32())
+        else:
+            return pyarrow.array([parse_date(v) for v in values],
+                                 pyarrow.timestamp('s', tz='UTC'))
+
+    def flush(self):
+        arrays = []
+        for (field, values, datatype) in zip(self.fields, self.columns,
+                                             self.types):
+            array = self.to_array(values, datatype)
+            if datatype == 'n' and array.null_count:
+                unparsed = array.null_count - values.count(None)
+                if unparsed:
+                    self.unparsed[field] += unparsed
+            arrays.append(array)
+        table = pyarrow.Table.from_arrays(arrays, list(self.fields))
+        if self.writer is None:
+            self.writer = pyarrow.parquet.ParquetWriter(self.path,
+                                                        table.schema)
+        self.writer.write_table(table)
+        self.columns = [[] for field in self.fields]
+
+    def close(self):
+        if self.columns[0] or self.writer is None:
+            self.flush()
+        self.writer.close()
+
+    @staticmethod
+    def concatenate(paths, out_path):
+        """
+        Write the row groups of the Parquet files in paths to out_path,
+        one file after another.
+        """
+        writer = None
+        try:
+            for path in paths:
+                f = pyarrow.parquet.ParquetFile(path)
+                if writer is None:
+                    writer = pyarrow.parquet.ParquetWriter(out_path,
+                                                           f.schema_arrow)
+                for i in range(f.num_row_groups):
+                    table = f.read_row_group(i)
+                    writer.write_table(table.cast(writer.schema))
+        finally:
+            if writer is not None:
+                writer.close()
+
+
+WRITERS = {
+    'csv': CSVWriter,
+    'parquet': ParquetWriter,
+}
+
+
+class TeeWriter(object):
+    """
+    Write each node to every one of writers (e.g. a file and a sink).
+    """
+    def __init__(self, writers):
+        self.writers = writers
+
+    def write(self, attributes):
+        for writer in self.writers:
+            writer.write(attributes)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
 class HealthDataExtractor(object):
     """
     Extract health data from Apple Health App's XML export, export.xml.
 
     Inputs:
-        path:      Relative or absolute path to export.xml
+        path:      Relative or absolute path to export.xml, or to the
+                   export.zip containing it, or an open binary stream
+                   of export.xml (e.g. a ZipFile member)
         verbose:   Set to False for less verbose output
+        streaming: Set to True to parse export.xml incrementally, handling
+                   and discarding one top-level node at a time, rather
+                   than building the whole tree in memory first.
+                   Peak memory then stays flat however large the export.
+        directory: Directory for the CSV files. Defaults to the
+                   directory of export.xml; for export.zip, to the
+                   apple_health_export folder that unzipping it would
+                   create; and for a stream, to the current directory.
+        output_format: 'csv' (the default) for quoted text CSV files or
+                   'parquet' for Parquet files with typed columns
+                   (see ParquetWriter; requires pyarrow), or None to
+                   write no files (e.g. when there is a sink).
+        processes: Number of worker processes. With more than one,
+                   export.xml (which must then be an uncompressed
+                   file) is split into byte ranges at top-level node
+                   boundaries, the ranges are streamed in parallel and
+                   their CSV files and counts merged in order, giving
+                   the same output as a serial run.
+        since:     For incremental runs, a dict mapping kinds to
+                   watermarks (naive UTC datetimes), as returned by
+                   load_watermarks(). Records and Workouts created at or
+                   before the watermark for their kind, less
+                   WATERMARK_LOOKBACK, are counted but not written, so
+                   each file holds only the new nodes and those of the
+                   last few days, which late-syncing sources may have
+                   added to (ActivitySummary, lacking a creationDate,
+                   is always written in full). The new watermarks are
+                   collected in self.watermarks, starting from since,
+                   so kinds without new nodes (or not extracted this
+                   time) keep theirs; call save_watermarks() once the
+                   new nodes have been loaded. Pass an empty dict for the
+                   first incremental run.
+        codes:     Set to True to write the INTERNED_FIELDS of CSV
+                   files (sourceName, device, type, ...) as small
+                   integer codes instead of (often long) strings, and
+                   their values to dictionary.csv. Codes carry over
+                   from any dictionary.csv already in directory, so
+                   they stay stable across incremental runs. Without
+                   codes, any dictionary.csv in directory is removed.
+        include:   If given, only the types (or Workout/ActivitySummary)
+                   named are extracted. Names are matched in lower case
+                   after abbreviation, e.g. 'heartrate', so the same
+                   lists serve for table names (see read_type_filter()).
+        exclude:   Types not to extract. Nodes of excluded types are
+                   dropped as soon as their start tag is parsed, before
+                   they are abbreviated, counted or written and without
+                   opening a file for them; they are counted, by type,
+                   in self.skipped.
+        sink:      Optional destination that is handed the nodes as they
+                   are parsed, as well as (or, with output_format None,
+                   instead of) the files: an object whose open(kind,
+                   fields, codes) returns a writer like CSVWriter's for
+                   each kind. The sink is opened and written to here but
+                   closed by the caller. Not available with processes.
 
     Outputs:
-        Writes a CSV file for each record type found, in the same
-        directory as the input export.xml. Reports each file written
-        unless verbose has been set to False.
+        Writes a CSV (or Parquet) file for each record type found,
+        in directory. Reports each file written unless verbose has been
+        set to False.
+
+    Each node is abbreviated, counted and written in a single pass
+    (see process()), so the statistics are collected by extract() and
+    calling report_stats() afterwards is free; calling it first costs
+    an extra (stats-only) pass.
     """
-    def __init__(self, path, verbose=VERBOSE):
+    def __init__(self, path, verbose=VERBOSE, streaming=STREAMING,
+                 directory=None, processes=PROCESSES,
+                 output_format=OUTPUT_FORMAT, since=None, codes=False,
+                 include=None, exclude=(), sink=None):
         self.in_path = path
         self.verbose = verbose
-        self.directory = os.path.abspath(os.path.split(path)[0])
-        with open(path) as f:
+        self.writer_class = output_format and WRITERS[output_format]
+        self.output_format = output_format
+        self.sink = sink
+        self.streaming = streaming or processes > 1
+        self.processes = processes
+        if processes > 1 and (sink is not None or output_format is None):
+            raise ValueError('Parallel extraction writes files, so needs '
+                             'an output_format and no sink')
+        if processes > 1 and (hasattr(path, 'read')
+                              or zipfile.is_zipfile(path)):
+            raise ValueError('Parallel extraction needs an uncompressed '
+                             'export.xml, not %s' % path)
+        if directory is None:
+            if hasattr(path, 'read'):
+                directory = os.getcwd()
+            elif zipfile.is_zipfile(path):
+                directory = os.path.join(os.path.split(path)[0],
+                                         os.path.split(EXPORT_MEMBER)[0])
+            else:
+                directory = os.path.split(path)[0]
+        self.directory = os.path.abspath(directory)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.stats_collected = False
+        self.since = since
+        if codes and output_format == 'csv':
+            values = (codes if isinstance(codes, dict)
+                      else load_dictionary(self.directory))
+            self.codes = OrderedDict((field, Codes(values.get(field, ())))
+                                     for field in INTERNED_FIELDS)
+        else:
+            self.codes = None
+        self.include = include
+        self.exclude = exclude
+        if include is not None or exclude:
+            self.wanted = TypeFilter(include, exclude)
+        else:
+            self.wanted = None
+        self.skipped = Counter()
+        self.watermarks = {}
+        self.new_records = Counter()
+        # (kind, field) -> values written as null, not being numbers
+        self.unparsed = Counter()
+        self.handles = {}
+        self.paths = []
+        # type -> kind (abbreviated type) of the records seen so far, and
+        # the kinds whose type is a category, kept across passes, as a
+        # pass over the tree leaves the types of its nodes abbreviated
+        self.kinds = {}
+        self.category_kinds = set()
+        if self.streaming:
+            return
+        f = open_export(path)
+        try:
             self.report('Reading data from %s . . . ' % path, end='')
             self.data = ElementTree.parse(f)
             self.report('done')
-        self.root = self.data._root
-        self.nodes = self.root.getchildren()
+        finally:
+            if f is not path:
+                f.close()
+        self.root = self.data.getroot()
+        self.nodes = list(self.root)
         self.n_nodes = len(self.nodes)
-        self.abbreviate_types()
-        self.collect_stats()
 
     def report(self, msg, end='\n'):
         if self.verbose:
             print(msg, end=end)
             sys.stdout.flush()
 
-    def count_tags_and_fields(self):
-        self.tags = Counter()
-        self.fields = Counter()
-        for record in self.nodes:
-            self.tags[record.tag] += 1
-            for k in record.keys():
-                self.fields[k] += 1
+    def iter_nodes(self):
+        """
+        Iterate over the top-level nodes of the export, either from the
+        tree already in memory or by streaming them from export.xml,
+        leaving out those of unwanted types.
+        """
+        self.skipped = Counter()
+        if self.streaming:
+            return self.stream_nodes()
+        elif self.wanted is None:
+            return iter(self.nodes)
+        else:
+            return (node for node in self.nodes if self.is_wanted(node))
+
+    def is_wanted(self, node):
+        """
+        Whether node is of a wanted type, counting it in self.skipped
+        if not. Nodes other than Records, Workouts and ActivitySummaries
+        (ExportDate, Me, ...) are always wanted.
+        """
+        if node.tag == 'Record':
+            kind = node.get('type')
+        elif node.tag in ('ActivitySummary', 'Workout'):
+            kind = node.tag
+        else:
+            return True
+        if kind is None or self.wanted(kind):
+            return True
+        self.skipped[type_name(kind)] += 1
+        return False
+
+    def stream_nodes(self):
+        """
+        Parse export.xml incrementally, yielding each top-level node
+        (Record, Workout, ActivitySummary, Me, ...) once it is complete.
 
-    def count_record_types(self):
+        The node is cleared from the tree as soon as the caller asks for
+        the next one, so only a single node is ever held in memory.
+        Nested elements (MetadataEntry, the Records inside a Correlation,
+        ...) are not yielded separately, matching the in-memory mode.
+        Nodes of unwanted types are judged on their start tag and
+        cleared, unseen by the caller, when they end.
         """
-        Counts occurrences of each type of (conceptual) "record" in the data.
+        self.report('Streaming data from %s' % self.in_path)
+        f = open_export(self.in_path)
+        is_wanted = self.is_wanted if self.wanted is not None else None
+        try:
+            root = None
+            depth = 0
+            keep = True
+            for (event, elem) in ElementTree.iterparse(f, ('start', 'end')):
+                if event == 'start':
+                    if root is None:
+                        root = elem
+                    depth += 1
+                    if depth == 2 and is_wanted is not None:
+                        keep = is_wanted(elem)
+                else:
+                    depth -= 1
+                    if depth == 1:
+                        if keep:
+                            yield elem
+                        root.clear()
+        finally:
+            if f is not self.in_path:
+                f.close()
 
-        In the case of nodes of type 'Record', this counts the number of
-        occurrences of each 'type' or record in self.record_types.
+    def output_path(self, kind, directory=None):
+        return os.path.join(directory or self.directory, '%s.%s'
+                            % (abbreviate(kind), self.writer_class.extension))
+
+    def open_for_writing(self, kind):
+        headerType = (kind if kind in ('Workout', 'ActivitySummary')
+                           else 'Record')
+        fields = FIELDS[headerType]
+        if kind in self.category_kinds:
+            fields = CATEGORY_FIELDS
+        writers = []
+        if self.writer_class is not None:
+            path = self.output_path(kind)
+            writers.append(self.writer_class(path, fields, self.codes))
+            self.paths.append(path)
+            self.report('Opening %s for writing' % path)
+        if self.sink is not None:
+            writers.append(self.sink.open(kind, fields, self.codes))
+        f = writers[0] if len(writers) == 1 else TeeWriter(writers)
+        self.handles[kind] = f
+        return f
+
+    def process(self, write=True):
+        """
+        Single pass over the nodes that, for each node in turn,
+        shortens its type, counts its tag, fields and (conceptual)
+        record type and, if write is True, writes it to the output file
+        for its kind, opening that file the first time the kind is seen.
+
+        In the case of nodes of type 'Record', the number of occurrences
+        of each 'type' of record is counted in self.record_types.
 
         In the case of nodes of type 'ActivitySummary' and 'Workout',
         it just counts those in self.other_types.
@@ -172,75 +1424,234 @@ class HealthDataExtractor(object):
         all Workout entries to a single file, and all ActivitySummary
         entries to another single file.
         """
+        if self.processes > 1:
+            self.process_parallel(write)
+            return
+        self.tags = Counter()
+        self.fields = Counter()
         self.record_types = Counter()
         self.other_types = Counter()
-        for record in self.nodes:
-            if record.tag == 'Record':
-                self.record_types[record.attrib['type']] += 1
-            elif record.tag in ('ActivitySummary', 'Workout'):
-                self.other_types[record.tag] += 1
-            elif record.tag in ('Export', 'Me'):
-                pass
+        self.n_nodes = 0
+        handles = self.handles
+        kinds = self.kinds
+        since = self.since
+        # kinds with no new nodes this run (or not extracted) keep theirs
+        watermarks = self.watermarks = dict(since or {})
+        cutoffs = dict((kind, watermark - WATERMARK_LOOKBACK)
+                       for (kind, watermark) in (since or {}).items())
+        self.new_records = Counter()
+        for node in self.iter_nodes():
+            self.n_nodes += 1
+            attributes = node.attrib
+            self.tags[node.tag] += 1
+            for k in attributes:
+                self.fields[k] += 1
+            if node.tag == 'Record':
+                if 'type' in attributes:
+                    type_id = attributes['type']
+                    kind = kinds.get(type_id)
+                    if kind is None:
+                        kind = kinds[type_id] = abbreviate(type_id)
+                        if type_id.startswith(CATEGORY_PREFIX):
+                            self.category_kinds.add(kind)
+                    attributes['type'] = kind
+                kind = attributes['type']
+                self.record_types[kind] += 1
+            elif node.tag in ('ActivitySummary', 'Workout'):
+                kind = node.tag
+                self.other_types[kind] += 1
             else:
-                self.report('Unexpected node of type %s.' % record.tag)
+                if node.tag not in ('ExportDate', 'Me'):
+                    self.report('Unexpected node of type %s.' % node.tag)
+                continue
+            if write:
+                f = handles.get(kind) or self.open_for_writing(kind)
+                if since is not None and node.tag in WATERMARK_FIELDS:
+                    created = parse_date(
+                        attributes.get(WATERMARK_FIELDS[node.tag]))
+                    if created is not None:
+                        if created > watermarks.get(kind, created.min):
+                            watermarks[kind] = created
+                        if kind in cutoffs and created <= cutoffs[kind]:
+                            continue
+                f.write(attributes)
+                self.new_records[kind] += 1
+        self.stats_collected = True
 
-    def collect_stats(self):
-        self.count_record_types()
-        self.count_tags_and_fields()
+    def worker_options(self):
+        """
+        Keyword arguments with which each worker's extractor is built.
+        """
+        return {'output_format': self.output_format, 'since': self.since,
+                'include': self.include, 'exclude': self.exclude,
+                'codes': self.codes and dict((field, values.values)
+                                             for (field, values)
+                                             in self.codes.items())}
 
-    def open_for_writing(self):
-        self.handles = {}
-        self.paths = []
-        for kind in (list(self.record_types) + list(self.other_types)):
-            path = os.path.join(self.directory, '%s.csv' % abbreviate(kind))
-            f = open(path, 'w')
-            headerType = (kind if kind in ('Workout', 'ActivitySummary')
-                               else 'Record')
-            f.write(','.join(FIELDS[headerType].keys()) + '\n')
-            self.handles[kind] = f
-            self.report('Opening %s for writing' % path)
+    def process_parallel(self, write=True):
+        """
+        Parallel version of process(): each byte range of export.xml is
+        processed by extract_chunk() in a pool of self.processes workers,
+        then the per-range output files are concatenated, in range order,
+        into the usual files in self.directory and the counters summed.
+        """
+        chunks = find_chunks(self.in_path,
+                             self.processes * CHUNKS_PER_PROCESS)
+        self.report('Extracting %d chunks of %s with %d processes'
+                    % (len(chunks), self.in_path, self.processes))
+        parts_dir = os.path.join(self.directory, '.parts')
+        options = self.worker_options()
+        tasks = [(self.in_path, start, end,
+                  os.path.join(parts_dir, '%05d' % i), write, options)
+                 for (i, (start, end)) in enumerate(chunks)]
+        self.tags = Counter()
+        self.fields = Counter()
+        self.record_types = Counter()
+        self.other_types = Counter()
+        self.n_nodes = 0
+        self.watermarks = dict(self.since or {})
+        self.new_records = Counter()
+        self.skipped = Counter()
+        self.unparsed = Counter()
+        parts = OrderedDict()
+        recoders = OrderedDict()
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            for (task, result) in zip(tasks, pool.imap(extract_chunk, tasks)):
+                (n_nodes, tags, fields, record_types, other_types,
+                 new_records, watermarks, skipped, unparsed, codes) = result
+                self.n_nodes += n_nodes
+                self.skipped.update(skipped)
+                self.unparsed.update(unparsed)
+                self.new_records.update(new_records)
+                for (kind, watermark) in watermarks.items():
+                    if watermark > self.watermarks.get(kind, watermark.min):
+                        self.watermarks[kind] = watermark
+                self.tags.update(tags)
+                self.fields.update(fields)
+                self.record_types.update(record_types)
+                self.other_types.update(other_types)
+                mappings = dict((field, [self.codes[field][value]
+                                         for value in values])
+                                for (field, values) in codes.items())
+                for kind in list(record_types) + list(other_types):
+                    parts.setdefault(kind, []).append(
+                        self.output_path(kind, task[3]))
+                    recoders.setdefault(kind, []).append(
+                        mappings and make_recoder(
+                            FIELDS['Record' if kind in record_types
+                                   else kind], mappings))
+        finally:
+            pool.close()
+            pool.join()
+        try:
+            for (kind, paths) in (parts.items() if write else ()):
+                path = self.output_path(kind)
+                if self.codes and self.writer_class is CSVWriter:
+                    CSVWriter.concatenate(paths, path, recoders[kind])
+                else:
+                    self.writer_class.concatenate(paths, path)
+                self.paths.append(path)
+                self.report('Written %s data.' % abbreviate(kind))
+        finally:
+            shutil.rmtree(parts_dir, ignore_errors=True)
+        self.stats_collected = True
+
+    def collect_stats(self):
+        self.process(write=False)
 
-    def abbreviate_types(self):
+    def save_watermarks(self):
         """
-        Shorten types by removing common boilerplate text.
+        Record the watermarks of this run in self.directory, so that
+        the next incremental run only extracts newer nodes.
         """
-        for node in self.nodes:
-            if node.tag == 'Record':
-                if 'type' in node.attrib:
-                    node.attrib['type'] = abbreviate(node.attrib['type'])
-
-    def write_records(self):
-        kinds = FIELDS.keys()
-        for node in self.nodes:
-            if node.tag in kinds:
-                attributes = node.attrib
-                kind = attributes['type'] if node.tag == 'Record' else node.tag
-                values = [format_value(attributes.get(field), datatype)
-                          for (field, datatype) in FIELDS[node.tag].items()]
-                line = encode(','.join(values) + '\n')
-                self.handles[kind].write(line)
+        save_watermarks(self.directory, self.watermarks)
+        self.report('Saved watermarks for %d kinds.' % len(self.watermarks))
 
     def close_files(self):
         for (kind, f) in self.handles.items():
             f.close()
+            for writer in getattr(f, 'writers', [f]):
+                for (field, n) in getattr(writer, 'unparsed', {}).items():
+                    self.unparsed[(kind, field)] += n
             self.report('Written %s data.' % abbreviate(kind))
+        self.handles = {}
 
     def extract(self):
-        self.open_for_writing()
-        self.write_records()
-        self.close_files()
+        try:
+            self.process()
+        finally:
+            self.close_files()
+        for ((kind, field), n) in sorted(self.unparsed.items()):
+            self.report('%d %s values of %s are not numbers; written as null.'
+                        % (n, field, abbreviate(kind)))
+        path = os.path.join(self.directory, DICTIONARY_FILE)
+        if self.codes:
+            path = save_dictionary(self.directory, self.codes)
+            self.report('Written dictionary to %s' % path)
+        elif os.path.exists(path):
+            # left by an earlier run with codes: the files written now
+            # hold the strings, and loaders take a dictionary to mean codes
+            os.remove(path)
+            self.report('Removed stale dictionary %s' % path)
 
     def report_stats(self):
+        if not self.stats_collected:
+            self.collect_stats()
         print('\nTags:\n%s\n' % format_freqs(self.tags))
         print('Fields:\n%s\n' % format_freqs(self.fields))
         print('Record types:\n%s\n' % format_freqs(self.record_types))
+        if self.skipped:
+            print('Skipped types:\n%s\n' % format_freqs(self.skipped))
 
 
-if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print('USAGE: python applehealthdata.py /path/to/export.xml',
-              file=sys.stderr)
-        sys.exit(1)
-    data = HealthDataExtractor(sys.argv[1])
-    data.report_stats()
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Extract a CSV file per record type from export.xml '
+                    '(or the export.zip containing it).')
+    parser.add_argument('path', help='/path/to/export.xml or export.zip')
+    parser.add_argument('-d', '--directory',
+                        help='directory for the output files')
+    parser.add_argument('-j', '--processes', type=int, default=PROCESSES,
+                        help='number of worker processes (export.xml only)')
+    parser.add_argument('-f', '--format', default=OUTPUT_FORMAT,
+                        choices=sorted(WRITERS), help='output format')
+    parser.add_argument('--codes', action='store_true',
+                        help='write repeated strings as integer codes')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only write nodes newer than the last run')
+    parser.add_argument('--config',
+                        help='ini file with a [%s] section giving include '
+                             'and/or exclude lists' % TYPES_SECTION)
+    parser.add_argument('--group', action='store_true',
+                        help='also write the grouped files (no database)')
+    parser.add_argument('--include', action='append',
+                        help='comma-separated types to extract')
+    parser.add_argument('--exclude', action='append', default=[],
+                        help='comma-separated types not to extract')
+    options = parser.parse_args(args)
+    (include, exclude) = (None, [])
+    if options.config:
+        (include, exclude) = read_type_filter(options.config)
+    if options.include:
+        include = split_names(options.include)
+    exclude = exclude + split_names(options.exclude)
+    data = HealthDataExtractor(options.path, streaming=True,
+                               directory=options.directory,
+                               processes=options.processes,
+                               output_format=options.format,
+                               codes=options.codes,
+                               include=include, exclude=exclude)
+    if options.incremental:
+        data.since = load_watermarks(data.directory)
     data.extract()
+    if options.incremental:
+        data.save_watermarks()
+    if options.group:
+        for path in group_files(data.directory):
+            data.report('Written %s' % path)
+    data.report_stats()
+
+
+if __name__ == '__main__':
+    main()
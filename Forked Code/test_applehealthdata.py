@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""
+test_applehealthdata.py: Tests of applehealthdata, run with
+
+    python -m unittest test_applehealthdata
+
+from the directory holding both.
+"""
+import contextlib
+import datetime
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from applehealthdata import (DICTIONARY_FILE, RECORD_FIELDS,
+                             HealthDataExtractor, TypeFilter, format_value,
+                             make_row_encoder, merge_intervals, parse_date,
+                             parse_timestamps,
+                             read_frame, pandas, pyarrow)
+
+EXPORT_XML = b'''<?xml version="1.0" encoding="UTF-8"?>
+<HealthData locale="en_US">
+ <Record type="HKQuantityTypeIdentifierHeartRate" sourceName="Watch"
+  sourceVersion="6.10" unit="count/min"
+  creationDate="2019-01-01 20:34:30 -0500"
+  startDate="2019-01-01 20:34:00 -0500"
+  endDate="2019-01-01 20:34:30 -0500" value="61"/>
+ <Record type="HKCategoryTypeIdentifierSleepAnalysis" sourceName="Watch"
+  sourceVersion="6.10" creationDate="2019-01-01 07:00:00 -0500"
+  startDate="2019-01-01 00:00:00 -0500"
+  endDate="2019-01-01 07:00:00 -0500"
+  value="HKCategoryValueSleepAnalysisInBed"/>
+ <ActivitySummary dateComponents="2019-10-28" activeEnergyBurned="500"
+  activeEnergyBurnedGoal="600" activeEnergyBurnedUnit="Cal"
+  appleExerciseTime="30" appleExerciseTimeGoal="30" appleStandHours="10"
+  appleStandHoursGoal="12"/>
+</HealthData>
+'''
+
+
+
+def make_export(n_records):
+    """
+    An export.xml holding n_records Records, of a few types and sources,
+    a Workout and an ActivitySummary.
+    """
+    kinds = [('HKQuantityTypeIdentifierHeartRate', 'count/min'),
+             ('HKQuantityTypeIdentifierStepCount', 'count'),
+             ('HKCategoryTypeIdentifierSleepAnalysis', None)]
+    sources = ['Watch', 'Tony&quot;s iPhone', 'Scale 100%', 'Ring']
+    lines = [b'<?xml version="1.0" encoding="UTF-8"?>',
+             b'<HealthData locale="en_US">']
+    start = datetime.datetime(2019, 1, 1)
+    for i in range(n_records):
+        (kind, unit) = kinds[i % len(kinds)]
+        date = (start + datetime.timedelta(minutes=i)).strftime(
+            '%Y-%m-%d %H:%M:%S -0500')
+        lines.append((
+            ' <Record type="%s" sourceName="%s" sourceVersion="6.%d"%s'
+            ' creationDate="%s" startDate="%s" endDate="%s" value="%s"/>'
+            % (kind, sources[i % len(sources)], i % 12,
+               ' unit="%s"' % unit if unit else '', date, date, date,
+               'HKCategoryValueSleepAnalysisAsleep' if unit is None
+               else i % 97)).encode('utf-8'))
+    lines.append(b' <Workout'
+                 b' workoutActivityType="HKWorkoutActivityTypeRunning"'
+                 b' duration="30" creationDate="2019-01-02 08:30:00 -0500"'
+                 b' startDate="2019-01-02 08:00:00 -0500"'
+                 b' endDate="2019-01-02 08:30:00 -0500"/>')
+    lines.append(b' <ActivitySummary dateComponents="2019-01-02"'
+                 b' activeEnergyBurned="500" appleStandHours="10"/>')
+    lines.append(b'</HealthData>\n')
+    return b'\n'.join(lines)
+
+
+class ExportTestCase(unittest.TestCase):
+    """
+    Base class of tests run on an export.xml (EXPORT_XML unless a test
+    writes its own with write_export) in a temporary directory.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'export.xml')
+        self.write_export(EXPORT_XML)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_export(self, xml):
+        with open(self.path, 'wb') as f:
+            f.write(xml)
+
+
+@unittest.skipIf(pandas is None, 'requires pandas')
+class ReadFrameTest(ExportTestCase):
+    def extract(self, output_format):
+        HealthDataExtractor(self.path, verbose=False,
+                            output_format=output_format).extract()
+
+    @unittest.skipIf(pyarrow is None, 'requires pyarrow')
+    def test_activity_summary_parquet(self):
+        self.extract('parquet')
+        frame = read_frame(os.path.join(self.directory,
+                                        'ActivitySummary.parquet'))
+        self.assertTrue(pandas.api.types.is_datetime64_any_dtype(
+            frame['dateComponents']))
+        self.assertEqual(frame['dateComponents'].iloc[0],
+                         pandas.Timestamp('2019-10-28'))
+
+    @unittest.skipIf(pyarrow is None, 'requires pyarrow')
+    def test_parquet_types_from_fields(self):
+        self.extract('parquet')
+        schema = pyarrow.parquet.read_schema(
+            os.path.join(self.directory, 'HeartRate.parquet'))
+        self.assertEqual(schema.field('value').type, pyarrow.float64())
+        frame = read_frame(os.path.join(self.directory,
+                                        'SleepAnalysis.parquet'))
+        self.assertEqual(frame['value'].iloc[0],
+                         'HKCategoryValueSleepAnalysisInBed')
+
+    @unittest.skipIf(pyarrow is None, 'requires pyarrow')
+    def test_category_values_after_stats(self):
+        data = HealthDataExtractor(self.path, verbose=False,
+                                   output_format='parquet')
+        with contextlib.redirect_stdout(io.StringIO()):
+            data.report_stats()
+        data.extract()
+        frame = read_frame(os.path.join(self.directory,
+                                        'SleepAnalysis.parquet'))
+        self.assertEqual(frame['value'].iloc[0],
+                         'HKCategoryValueSleepAnalysisInBed')
+
+    def test_category_csv_after_stats(self):
+        data = HealthDataExtractor(self.path, verbose=False)
+        with contextlib.redirect_stdout(io.StringIO()):
+            data.report_stats()
+        data.extract()
+        with open(os.path.join(self.directory, 'SleepAnalysis.csv')) as f:
+            self.assertTrue(f.readlines()[1].rstrip().endswith(
+                ',"HKCategoryValueSleepAnalysisInBed"'))
+
+    def test_csv_strings_stay_text(self):
+        self.extract('csv')
+        frame = read_frame(os.path.join(self.directory, 'HeartRate.csv'))
+        self.assertEqual(frame['sourceVersion'].iloc[0], '6.10')
+        self.assertEqual(frame['value'].iloc[0], 61.0)
+        self.assertEqual(frame['startDate'].iloc[0],
+                         pandas.Timestamp('2019-01-01 20:34:00'))
+
+
+class TypeFilterTest(ExportTestCase):
+    def test_names_match_after_abbreviation(self):
+        wanted = TypeFilter(include=['heartrate', 'SleepAnalysis',
+                                     'Workout'],
+                            exclude=['HKCategoryTypeIdentifierSleepAnalysis'])
+        self.assertTrue(wanted('HKQuantityTypeIdentifierHeartRate'))
+        self.assertTrue(wanted('HeartRate'))
+        self.assertTrue(wanted('Workout'))
+        self.assertFalse(wanted('HKCategoryTypeIdentifierSleepAnalysis'))
+        self.assertFalse(wanted('HKQuantityTypeIdentifierStepCount'))
+        self.assertFalse(wanted('ActivitySummary'))
+        self.assertTrue(TypeFilter()('ActivitySummary'))
+
+    def test_excluded_types_not_extracted(self):
+        for streaming in (False, True):
+            data = HealthDataExtractor(self.path, verbose=False,
+                                       streaming=streaming,
+                                       exclude=['sleepanalysis',
+                                                'ActivitySummary'])
+            data.extract()
+            self.assertEqual(sorted(os.listdir(self.directory)),
+                             ['HeartRate.csv', 'export.xml'])
+            self.assertEqual(data.skipped,
+                             {'sleepanalysis': 1, 'activitysummary': 1})
+            self.assertEqual(data.record_types, {'HeartRate': 1})
+
+
+@unittest.skipIf(pandas is None, 'requires pandas')
+class ParseTimestampsTest(unittest.TestCase):
+    # both sides of the spring and autumn changes of US Eastern time,
+    # as the export writes them, with the offset of the time
+    VALUES = ['2019-03-10 01:30:00 -0500', '2019-03-10 03:30:00 -0400',
+              '2019-11-03 01:30:00 -0400', '2019-11-03 01:30:00 -0500',
+              '2019-11-03 02:30:00 -0500', None]
+
+    def test_utc_matches_parse_date(self):
+        times = parse_timestamps(pandas.Series(self.VALUES), timezone=None)
+        self.assertEqual(list(times[:-1]),
+                         [pandas.Timestamp(parse_date(value))
+                          for value in self.VALUES[:-1]])
+        self.assertTrue(pandas.isnull(times.iloc[-1]))
+
+    def test_local_times_across_changes(self):
+        times = parse_timestamps(pandas.Series(self.VALUES),
+                                 timezone='America/New_York')
+        self.assertEqual(list(times[:-1]),
+                         [pandas.Timestamp(value[:19])
+                          for value in self.VALUES[:-1]])
+        # the repeated hour in November is an hour apart in UTC
+        utc = parse_timestamps(pandas.Series(self.VALUES), timezone=None)
+        self.assertEqual(utc[3] - utc[2], pandas.Timedelta(hours=1))
+        self.assertEqual(utc[1] - utc[0], pandas.Timedelta(hours=1))
+
+
+@unittest.skipIf(pandas is None, 'requires pandas')
+class MergeIntervalsTest(unittest.TestCase):
+    def test_sessions(self):
+        intervals = [
+            # night of the 1st: a long interval holding a short one, one
+            # overlapping its end, one touching that, and one after a gap
+            ('2019-01-01', '23:00:00', '23:30:00'),
+            ('2019-01-01', '22:00:00', '23:50:00'),
+            ('2019-01-01', '23:40:00', '23:59:00'),
+            ('2019-01-01', '23:59:00', '23:59:30'),
+            ('2019-01-01', '23:59:31', '23:59:45'),
+            # the next night, overlapping the last of the 1st
+            ('2019-01-02', '23:59:40', '23:59:50'),
+            ('2019-01-02', None, '23:59:55'),
+        ]
+        frame = pandas.DataFrame({
+            'TheDate': pandas.to_datetime([day + ' 12:00'
+                                           for (day, start, end)
+                                           in intervals]),
+            'startDate': pandas.to_datetime([
+                start and '2019-01-01 ' + start
+                for (day, start, end) in intervals]),
+            'endDate': pandas.to_datetime([
+                '2019-01-01 ' + end for (day, start, end) in intervals]),
+        })
+        expected = pandas.DataFrame({
+            'TheDate': pandas.to_datetime(['2019-01-01', '2019-01-01',
+                                           '2019-01-02']),
+            'startDate': pandas.to_datetime(['2019-01-01 22:00:00',
+                                             '2019-01-01 23:59:31',
+                                             '2019-01-01 23:59:40']),
+            'endDate': pandas.to_datetime(['2019-01-01 23:59:30',
+                                           '2019-01-01 23:59:45',
+                                           '2019-01-01 23:59:50']),
+        })
+        pandas.testing.assert_frame_equal(merge_intervals(frame), expected)
+
+
+class RowEncoderTest(unittest.TestCase):
+    def test_matches_format_value(self):
+        encode_row = make_row_encoder(RECORD_FIELDS)
+        rows = [
+            {'sourceName': 'Tony"s 100% iPhone', 'device': 'a\\b',
+             'type': 'StepCount', 'startDate': '2019-01-01 20:34:00 -0500',
+             'value': '12'},
+            {'sourceName': 'Tony"s 100% iPhone', 'type': 'StepCount',
+             'unit': 'count', 'value': '7%'},
+        ]
+        for attributes in rows * 2:
+            expected = ','.join(format_value(attributes.get(field), datatype)
+                                for (field, datatype)
+                                in RECORD_FIELDS.items()) + '\n'
+            self.assertEqual(encode_row(attributes), expected)
+
+
+class CodesTest(ExportTestCase):
+    def test_stale_dictionary_removed(self):
+        dictionary = os.path.join(self.directory, DICTIONARY_FILE)
+        HealthDataExtractor(self.path, verbose=False, codes=True).extract()
+        self.assertTrue(os.path.exists(dictionary))
+        HealthDataExtractor(self.path, verbose=False).extract()
+        self.assertFalse(os.path.exists(dictionary))
+
+
+class WatermarksTest(ExportTestCase):
+    def test_kinds_not_written_keep_their_watermark(self):
+        since = {'StepCount': datetime.datetime(2018, 5, 1)}
+        data = HealthDataExtractor(self.path, verbose=False, since=since)
+        data.extract()
+        self.assertEqual(data.watermarks['StepCount'],
+                         datetime.datetime(2018, 5, 1))
+        self.assertEqual(data.watermarks['HeartRate'],
+                         datetime.datetime(2019, 1, 2, 1, 34, 30))
+
+    def test_late_nodes_within_lookback_are_written(self):
+        created = datetime.datetime(2019, 1, 2, 1, 34, 30)
+        for (days, written) in ((1, 1), (4, 0)):
+            since = {'HeartRate': created + datetime.timedelta(days=days)}
+            data = HealthDataExtractor(self.path, verbose=False, since=since)
+            data.extract()
+            self.assertEqual(data.new_records['HeartRate'], written)
+
+
+
+class ParallelTest(ExportTestCase):
+    def extract(self, name, **options):
+        """
+        Extract the export into directory name, returning the contents of
+        the files written, by file name.
+        """
+        directory = os.path.join(self.directory, name)
+        HealthDataExtractor(self.path, verbose=False, directory=directory,
+                            **options).extract()
+        contents = {}
+        for name in os.listdir(directory):
+            with open(os.path.join(directory, name), 'rb') as f:
+                contents[name] = f.read()
+        return contents
+
+    # small chunks, so that each worker processes several
+    @mock.patch('applehealthdata.MIN_CHUNK_SIZE', 4096)
+    def test_same_files_as_serial(self):
+        self.write_export(make_export(2000))
+        for codes in (False, True):
+            serial = self.extract('serial%d' % codes, codes=codes)
+            parallel = self.extract('parallel%d' % codes, codes=codes,
+                                    processes=2)
+            self.assertEqual(sorted(parallel), sorted(serial))
+            for name in serial:
+                self.assertEqual(parallel[name], serial[name], name)
+
+
+if __name__ == '__main__':
+    unittest.main()
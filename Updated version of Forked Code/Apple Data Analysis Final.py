@@ -2,54 +2,281 @@
 # coding: utf-8
 
 import pandas
-import psycopg2
-from configparser import ConfigParser
 import numpy 
-path = 'C:/Users/tonyr/Desktop/Self Education/Production Files/apple_health_export/'
+import healthdb
+import hashlib
+import glob
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
 import os
+import sys
+# applehealthdata.py, in the Forked Code directory beside this one, defines
+# the rollup pyramids kept by the loader (Apple Health Final) for rollup()
+try:
+    HERE = os.path.dirname(os.path.abspath(__file__))
+except NameError:
+    # in the notebook, which runs in its own directory
+    HERE = os.getcwd()
+sys.path.insert(0, os.path.join(HERE, os.pardir, 'Forked Code'))
+from applehealthdata import ROLLUP_LEVELS, rollup_table
+path = 'C:/Users/tonyr/Desktop/Self Education/Production Files/apple_health_export/'
 prodfiles = 'C:/Users/tonyr/desktop/Self Education/Production Files/'
 os.chdir(prodfiles)
 
+# Rows fetched from the server-side cursor at a time by chunks()
+CHUNK_ROWS = 50000
+
+# Where connect() keeps the results it has read, as Parquet files (if
+# pyarrow is installed), and how many bytes of them, the least recently
+# used being deleted first
+CACHE_DIRECTORY = prodfiles + 'cache/'
+CACHE_BYTES = 500 << 20
+
+# Rolling features of sleep() and sm(), as (column, name prefix, windows
+# in days, statistics) for rolling_features()
+SLEEP_FEATURES = [('SleepTime', 'Sleep', [3, 5], ['sum', 'mean'])]
+SM_FEATURES = [('MeditationCategorical', 'MeditationCategorical', [3, 5], ['sum']),
+               ('MeditationTime', 'Meditation', [3, 5], ['sum', 'mean'])]
+
+# How rolling features are named, as in Sleep_Rolling_ThreeDayAverage
+WINDOW_NAMES = {3: 'Three', 5: 'Five', 7: 'Seven', 14: 'Fourteen', 30: 'Thirty'}
+STATISTIC_NAMES = {'sum': 'Sum', 'mean': 'DayAverage', 'count': 'Count'}
+
+# PostgreSQL type OIDs (cursor.description type_code) of the columns that
+# export() writes as DataFrame.to_csv() would, not as COPY does
+BOOL_OID = 16
+FLOAT_OIDS = (700, 701)
+TEXT_OIDS = (25, 1042, 1043)
+
+MEDITATION_LABELS = {1: 'Meditation Ended Within 30 Minutes of Sleeping',
+                     0: 'Mediation Ended More than 30 Minutes before Sleeping'}
+
+
+def rolling_features(frame, features):
+    """ Rolling statistics of the columns of frame, which has a sorted
+    DatetimeIndex, as a DataFrame on the same index. For each (column,
+    prefix, windows, statistics) of features, each statistic ('sum', 'mean'
+    or 'count' of the values present) over each window ending at each row:
+    a number of calendar days, or a span such as '15min' for minute-level
+    data. Windows are calendar time, not rows, so a missing night neither
+    counts as a zero nor stretches the window.
+
+    A running (prefix) sum and count of every column are taken in one
+    pass, and each window's start found by binary search, so any window
+    is a subtraction, however long it is or many rows it holds. Empty
+    windows give 0, as fillna(0) did. """
+    columns = []
+    for (column, prefix, windows, statistics) in features:
+        if column not in columns:
+            columns.append(column)
+    times = frame.index.values.astype('datetime64[ns]').astype(numpy.int64)
+    values = frame[columns].to_numpy(dtype=float)
+    present = ~numpy.isnan(values)
+    sums = numpy.vstack([numpy.zeros((1, len(columns))), numpy.cumsum(numpy.where(present, values, 0), axis=0)])
+    counts = numpy.vstack([numpy.zeros((1, len(columns))), numpy.cumsum(present, axis=0)])
+    end = numpy.arange(1, len(times) + 1)
+    starts = {}
+    result = {}
+    for (column, prefix, windows, statistics) in features:
+        j = columns.index(column)
+        for window in windows:
+            if window not in starts:
+                span = pandas.Timedelta(days=window) if isinstance(window, int) else pandas.Timedelta(window)
+                starts[window] = numpy.searchsorted(times, times - span.value, side='right')
+            total = sums[end, j] - sums[starts[window], j]
+            count = counts[end, j] - counts[starts[window], j]
+            for statistic in statistics:
+                if statistic == 'sum':
+                    feature = total
+                elif statistic == 'mean':
+                    feature = numpy.divide(total, count, out=numpy.zeros(len(total)), where=count > 0)
+                elif statistic == 'count':
+                    feature = count
+                else:
+                    raise ValueError('Unsupported rolling statistic: %s' % statistic)
+                result['%s_Rolling_%s%s' % (prefix, WINDOW_NAMES.get(window, window), STATISTIC_NAMES[statistic])] = feature
+    return pandas.DataFrame(result, index=frame.index)
+
+
+def csv_column(name, type_code):
+    """ SQL selecting the column name, of type OID type_code, formatted
+    as DataFrame.to_csv() writes it rather than as COPY does: booleans as
+    True/False (not t/f), floats as Python writes them (61.0, not 61, for
+    whole numbers, and NaN as empty) and empty strings as empty (not "").
+    Other columns are selected as they are """
+    column = healthdb.quote(name)
+    if type_code == BOOL_OID:
+        return "CASE WHEN {0} THEN 'True' WHEN NOT {0} THEN 'False' END AS {0}".format(column)
+    elif type_code in FLOAT_OIDS:
+        return ("CASE WHEN {0} = 'NaN' THEN NULL"
+                " WHEN {0} = trunc({0}) AND abs({0}) < 1e15 THEN trunc({0})::numeric || '.0'"
+                " ELSE {0}::text END AS {0}".format(column))
+    elif type_code in TEXT_OIDS:
+        return "NULLIF({0}, '') AS {0}".format(column)
+    return column
+
 
 class data_analysis():
 
 
     def __init__(self):
-        self = self
+        # 'postgresql' or 'sqlite' (see healthdb.backend)
+        self.backend = healthdb.backend(prodfiles + 'database.ini')
         
     def config(self,filename='database.ini', section='postgresql'):
-        parser = ConfigParser()
-        parser.read(filename)    
-        db = {}
-        if parser.has_section(section):
-            params = parser.items(section)
-            for param in params:
-                db[param[0]] = param[1]
-        else:
-            raise Exception('Section {0} not found in the {1} file'.format(section, filename))
-        return db
-
-    def connect(self,table):
+        return healthdb.config(prodfiles + filename, section)
+
+    def query(self, table, columns=None, datecolumn='startDate', start=None, end=None, where=None, params=None):
+        """ The SELECT of columns (all unless given) from table, and its
+        parameters, with the rows filtered by the database: datecolumn from
+        start up to end, where either is given, and the predicate where (SQL,
+        with %s for each of params, whatever the backend). SQLite keeps
+        dates as text, so they are compared as text """
+        mark = healthdb.PLACEHOLDERS[self.backend]
+        conditions = []
+        values = []
+        if start is not None:
+            conditions.append('%s >= %s' % (healthdb.quote(datecolumn), mark))
+            values.append(start)
+        if end is not None:
+            conditions.append('%s < %s' % (healthdb.quote(datecolumn), mark))
+            values.append(end)
+        if where:
+            conditions.append('(' + where.replace('%s', mark) + ')')
+            values.extend(params or [])
+        command = 'SELECT %s FROM %s' % (', '.join(healthdb.quote(col) for col in columns) if columns else '*',
+                                         healthdb.quote(table))
+        if conditions:
+            command += ' WHERE ' + ' AND '.join(conditions)
+        if self.backend == 'sqlite':
+            values = [str(value) if hasattr(value, 'isoformat') else value for value in values]
+        return command, values
+
+    def chunks(self, table, chunksize=CHUNK_ROWS, **query):
+        """ The rows of table (filtered as by query()) as DataFrames of up
+        to chunksize rows, streamed from a server-side cursor (SQLite's
+        cursors step through the rows as they are fetched anyway) so only one
+        chunk is held at a time """
+        command, values = self.query(table, **query)
+        conn = healthdb.raw_connection(prodfiles + 'database.ini')
+        try:
+            if self.backend == 'sqlite':
+                cur = conn.cursor()
+            else:
+                cur = conn.cursor(name='chunks_' + table)
+                cur.itersize = chunksize
+            cur.execute(command, values)
+            while True:
+                rows = cur.fetchmany(chunksize)
+                if not rows:
+                    break
+                yield pandas.DataFrame(rows, columns=[desc[0] for desc in cur.description])
+            cur.close()
+        finally:
+            conn.close()
+
+    def connect(self, table, cache=True, **query):
+        """ Query table through the shared connection pool, a chunk at a
+        time, with any columns, date range or predicate (see query()) applied
+        by the database. Results are cached (see cached()) unless cache is
+        False """
         DF = pandas.DataFrame()
-        """ Connect to the PostgreSQL database server """
+        try:
+            path = self.cached(table, **query) if cache and pyarrow is not None else None
+            if path is not None and os.path.exists(path):
+                os.utime(path, None)
+                return pandas.read_parquet(path)
+            chunks = list(self.chunks(table, **query))
+            if chunks:
+                DF = pandas.concat(chunks, ignore_index=True)
+            if path is not None:
+                self.store(DF, path)
+        except healthdb.database_errors() as error:
+            print(error)
+        return DF
+
+    def cached(self, table, **query):
+        """ The path of the cache file for the result of query() on table
+        as of the current load generation (see healthdb.load_generation), so
+        that the first read after each load goes back to the database """
+        conn = healthdb.raw_connection(prodfiles + 'database.ini')
+        try:
+            generation = healthdb.load_generation(conn)
+        finally:
+            conn.close()
+        key = hashlib.sha1(repr((table, sorted(query.items()))).encode('utf-8')).hexdigest()
+        return '%s%s-%d.parquet' % (CACHE_DIRECTORY, key, generation)
+
+    def store(self, DF, path):
+        """ Cache DF at path, replacing the entries for the same query from
+        earlier generations, then delete the least recently used entries
+        until the cache is within CACHE_BYTES """
+        if not os.path.isdir(CACHE_DIRECTORY):
+            os.makedirs(CACHE_DIRECTORY)
+        for old in glob.glob(path.rsplit('-', 1)[0] + '-*.parquet'):
+            os.remove(old)
+        try:
+            DF.to_parquet(path, index=False)
+        except (Exception) as error:
+            # not every column converts (mixed types, say): go uncached
+            print(error)
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        entries = sorted(glob.glob(CACHE_DIRECTORY + '*.parquet'), key=os.path.getmtime)
+        total = sum(os.path.getsize(entry) for entry in entries)
+        while entries and total > CACHE_BYTES:
+            total -= os.path.getsize(entries[0])
+            os.remove(entries.pop(0))
+
+    def export(self, table, filename, **query):
+        """ Write table (filtered as by query()) to the CSV file filename,
+        with a header, straight from PostgreSQL by COPY, with no DataFrame in
+        between (from SQLite, which has no COPY, a chunk at a time). Booleans
+        and floats are formatted by csv_column() as DataFrame.to_csv() wrote
+        them; integer columns with NULLs stay integers, where a DataFrame
+        would have made them floats """
         conn = None
         try:
-            command = """
-            Select * from """ + table + """
-            """
-            params = self.config(filename='database.ini', section='postgresql')
-            conn = psycopg2.connect(**params)
+            if self.backend == 'sqlite':
+                with open(filename, 'w', newline='') as f:
+                    for (n, chunk) in enumerate(self.chunks(table, **query)):
+                        chunk.to_csv(f, header=n == 0, index=False)
+                return
+            from psycopg2 import sql
+            conn = healthdb.raw_connection(prodfiles + 'database.ini')
             cur = conn.cursor()
-            cur.execute(command)
-            colnames = [desc[0] for desc in cur.description]
-            DF = pandas.DataFrame(cur.fetchall())
-            DF.columns = colnames
-        except (Exception, psycopg2.DatabaseError) as error:
+            command, values = self.query(table, **query)
+            cur.execute(command + ' LIMIT 0', values)
+            command = 'SELECT %s FROM (%s) AS exported' % (
+                ', '.join(csv_column(desc.name, desc.type_code) for desc in cur.description), command)
+            with open(filename, 'w', newline='') as f:
+                cur.copy_expert(sql.SQL('COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER true)').format(
+                    sql.SQL(cur.mogrify(command, values).decode())), f)
+            cur.close()
+        except healthdb.database_errors() as error:
             print(error)
         finally:
             if conn is not None:
                 conn.close()
-            return DF
+
+    def rollup(self, table, level='day', start=None, end=None, cache=True):
+        """ The values of table (such as 'heartrate') summed up per period
+        of level, one of ROLLUP_LEVELS (in applehealthdata): their sum,
+        count, min, max and mean, read from that level of the table's rollup
+        pyramid alone, so no raw rows are scanned. start and end (if given)
+        bound the periods """
+        levels = [name for (name, below) in ROLLUP_LEVELS]
+        if level not in levels:
+            raise ValueError('Unknown level %s, not one of %s' % (level, ', '.join(levels)))
+        DF = self.connect(rollup_table(table, level), cache=cache, datecolumn='period', start=start, end=end)
+        if len(DF):
+            DF['period'] = pandas.to_datetime(DF['period'])
+            DF = DF.sort_values('period').reset_index(drop=True)
+            DF['mean'] = DF['sum'] / DF['count'].where(DF['count'] > 0)
+        return DF
 
     def mindfulg(self):
 #         path = 'C:/Users/tonyr/Desktop/Self Education/Production Files/apple_health_export/'
@@ -57,23 +284,14 @@ class data_analysis():
         mindfulgrouped = d.groupby(['TheDate','endedWithinThirtyMinsOfSleeping'],as_index=False)['unithours'].sum()
         return mindfulgrouped
 
-    def changeMeditationValues (self,row):
-        if row['endedWithinThirtyMinsOfSleeping'] == 1 :
-            return 'Meditation Ended Within 30 Minutes of Sleeping'            
-        elif row['endedWithinThirtyMinsOfSleeping'] == 0:
-            return 'Mediation Ended More than 30 Minutes before Sleeping'
-
     def sleep(self):
         path = 'C:/Users/tonyr/Desktop/Self Education/Production Files/apple_health_export/'
         sleep = pandas.read_csv(path + 'Grouped/grouped_SleepAnalysis.csv')[['sum','TheDate']]
         sleep = sleep.rename(columns={"sum": "SleepTime", "TheDate": "SleepDate"})
         sleep['SleepDate'] = pandas.to_datetime(sleep['SleepDate'])
-        sleep['Sleep_Rolling_ThreeSum'] = sleep['SleepTime'].rolling(window=3).sum().fillna(0)
-        sleep['Sleep_Rolling_ThreeDayAverage'] = sleep['SleepTime'].rolling(window=3).mean().fillna(0)
-        sleep['Sleep_Rolling_FiveDayAverage'] = sleep['SleepTime'].rolling(window=5).mean().fillna(0)
-        sleep = sleep[sleep['SleepDate']  > '2019-07-01'] 
-        sleep.sort_values(by=['SleepDate'], inplace = True)
-        sleep.set_index('SleepDate', inplace=True)
+        sleep = sleep.sort_values(by=['SleepDate']).set_index('SleepDate')
+        sleep = pandas.concat([sleep, rolling_features(sleep, SLEEP_FEATURES)], axis=1)
+        sleep = sleep[sleep.index > '2019-07-01']
         return sleep
 
     def meditation(self):
@@ -91,24 +309,16 @@ class data_analysis():
         sm = sleep.join(meditation,lsuffix='_sleep', rsuffix = '_meditation').fillna(0)
         sm = sm[sm['SleepTime'] > 1]
         sm['MeditationCategorical'] =  numpy.where(sm['MeditationTime'] == 0, 0 , 1)
-        sm['MeditationCategorical_Rolling_ThreeSum'] = sm['MeditationCategorical'].rolling(window=3).sum().fillna(0)
-        sm['MeditationCategorical_Rolling_FiveSum'] = sm['MeditationCategorical'].rolling(window=5).sum().fillna(0)
-        sm['Meditation_Rolling_ThreeSum'] = sm['MeditationTime'].rolling(window=3).sum().fillna(0)
-        sm['Meditation_Rolling_FiveSum'] = sm['MeditationTime'].rolling(window=5).sum().fillna(0)
-        sm['Meditation_Rolling_ThreeDayAverage'] = sm['MeditationTime'].rolling(window=3).mean().fillna(0)
-        sm['Meditation_Rolling_FiveDayAverage'] = sm['MeditationTime'].rolling(window=5).mean().fillna(0)
-        sm['endedWithinThirtyMinsOfSleeping'] = sm.apply(lambda row: self.changeMeditationValues(row), axis=1)
+        sm = pandas.concat([sm, rolling_features(sm, SM_FEATURES)], axis=1)
+        sm['endedWithinThirtyMinsOfSleeping'] = sm['endedWithinThirtyMinsOfSleeping'].map(MEDITATION_LABELS)
         return sm
 
 if __name__ == '__main__':
     path = 'C:/Users/tonyr/Desktop/Self Education/Production Files/apple_health_export/'
     a = data_analysis()
     sm = a.sm()
-    sleephappy = a.connect('sleephappy')
-    sleephappy.to_csv(prodfiles + 'sleephappy.csv',index =False)
+    a.export('sleephappy', prodfiles + 'sleephappy.csv')
     heartrate = a.connect('heartratecompare')
-    heartrate_concat = a.connect('heartratecompareconcat')
-    heartrate_concat.to_csv(prodfiles + 'heartratecompare_concat.csv',index = False)
-    calories_burned = a.connect('caloriesburned')
-    calories_burned.to_csv(prodfiles + 'caloriesburned.csv', index = False)
+    a.export('heartratecompareconcat', prodfiles + 'heartratecompare_concat.csv')
+    a.export('caloriesburned', prodfiles + 'caloriesburned.csv')
     mindfulgrouped = a.mindfulg().groupby(['TheDate','endedWithinThirtyMinsOfSleeping'],as_index=False)['unithours'].sum()
\ No newline at end of file
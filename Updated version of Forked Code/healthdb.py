@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+healthdb.py: The database connection layer shared by ApplePostGre
+(Apple Health Final) and data_analysis (Apple Data Analysis Final).
+
+The connection parameters are read from database.ini once, and a single
+SQLAlchemy engine is built from them. Its connection pool hands out the
+raw DB-API connections that the loaders and queries use, so callers
+borrow a connection and give it back (close() returns it to the pool)
+rather than opening one of their own.
+
+The loader also counts its loads (the load generation), so that readers
+can tell whether results they cached are still current.
+
+The database is PostgreSQL unless database.ini chooses SQLite, a single
+file needing no server, as in
+
+    [storage]
+    backend = sqlite
+
+    [sqlite]
+    database = C:/Users/tonyr/desktop/Self Education/Production Files/health.db
+
+psycopg2 is only imported once a PostgreSQL engine is built, so SQLite
+needs no PostgreSQL driver installed.
+"""
+from configparser import ConfigParser
+import sqlite3
+import sys
+
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+
+PRODUCTION_FILES = 'C:/Users/tonyr/desktop/Self Education/Production Files/'
+DATABASE_INI = PRODUCTION_FILES + 'database.ini'
+SECTION = 'postgresql'
+
+# Section of database.ini naming the backend, the backends there are, the
+# section with the SQLite database file, and how each marks a parameter.
+STORAGE_SECTION = 'storage'
+BACKENDS = ('postgresql', 'sqlite')
+SQLITE_SECTION = 'sqlite'
+PLACEHOLDERS = {'postgresql': '%s', 'sqlite': '?'}
+
+# Connections kept open by the pool, and allowed on top of those at busy
+# times (e.g. while loading tables in parallel).
+POOL_SIZE = 5
+MAX_OVERFLOW = 10
+
+# Single-row table holding the load generation.
+GENERATION_TABLE = 'load_generation'
+
+_engines = {}
+
+
+def config(filename=DATABASE_INI, section=SECTION):
+    """
+    The connection parameters in section of the ini file filename (for
+    psycopg2.connect(), or the SQLite database file), as a dict.
+    """
+    parser = ConfigParser()
+    parser.read(filename)
+    if not parser.has_section(section):
+        raise Exception('Section {0} not found in the {1} file'
+                        .format(section, filename))
+    return dict(parser.items(section))
+
+
+def backend(filename=DATABASE_INI):
+    """
+    The backend chosen in the ini file filename: 'postgresql' (the
+    default) or 'sqlite'.
+    """
+    parser = ConfigParser()
+    parser.read(filename)
+    name = parser.get(STORAGE_SECTION, 'backend', fallback=BACKENDS[0])
+    if name not in BACKENDS:
+        raise Exception('Unknown backend {0} in the {1} file'
+                        .format(name, filename))
+    return name
+
+
+def connect_sqlite(path):
+    """
+    A connection to the SQLite database file path, usable from any thread
+    (the pool hands connections to the loader's threads), in WAL mode so
+    reading doesn't wait for writing.
+    """
+    conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    return conn
+
+
+def get_engine(filename=DATABASE_INI, section=SECTION):
+    """
+    The engine for the database configured in filename, built (with its
+    pool) the first time it is asked for and shared from then on.
+    """
+    key = (filename, section)
+    if key not in _engines:
+        if backend(filename) == 'sqlite':
+            path = config(filename, SQLITE_SECTION)['database']
+
+            def connect():
+                return connect_sqlite(path)
+            url = 'sqlite://'
+        else:
+            import psycopg2
+            params = config(filename, section)
+
+            def connect():
+                return psycopg2.connect(**params)
+            url = 'postgresql+psycopg2://'
+        _engines[key] = create_engine(url,
+                                      creator=connect,
+                                      poolclass=QueuePool,
+                                      pool_size=POOL_SIZE,
+                                      max_overflow=MAX_OVERFLOW,
+                                      pool_pre_ping=True)
+    return _engines[key]
+
+
+def raw_connection(filename=DATABASE_INI, section=SECTION):
+    """
+    A psycopg2 (or sqlite3) connection borrowed from the shared pool;
+    close() gives it back.
+    """
+    return get_engine(filename, section).raw_connection()
+
+
+def database_errors():
+    """
+    The base exception classes of the database drivers: sqlite3's, and
+    psycopg2's if it has been imported (by a PostgreSQL engine).
+    """
+    psycopg2 = sys.modules.get('psycopg2')
+    return (sqlite3.Error,) + ((psycopg2.Error,) if psycopg2 else ())
+
+
+def quote(name):
+    """
+    name quoted as an SQL identifier, for either backend.
+    """
+    return '"%s"' % name.replace('"', '""')
+
+
+def load_generation(conn):
+    """
+    The load generation of the database conn is connected to: how many
+    loads have changed it (0 before the first).
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute('SELECT generation FROM ' + GENERATION_TABLE)
+        row = cur.fetchone()
+    except database_errors():
+        # no load has made the table yet
+        conn.rollback()
+        row = None
+    cur.close()
+    return row[0] if row else 0
+
+
+def bump_generation(cur):
+    """
+    Count another load, in the transaction of cur (commit it with the
+    load, so readers never see the new generation with the old data).
+    """
+    cur.execute('CREATE TABLE IF NOT EXISTS ' + GENERATION_TABLE +
+                ' (generation bigint NOT NULL)')
+    cur.execute('UPDATE ' + GENERATION_TABLE +
+                ' SET generation = generation + 1')
+    if cur.rowcount == 0:
+        cur.execute('INSERT INTO ' + GENERATION_TABLE + ' VALUES (1)')
+
+
+def dispose():
+    """
+    Close every pooled connection, e.g. before forking or at exit.
+    """
+    for engine in _engines.values():
+        engine.dispose()
+    _engines.clear()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+test_apple_data_analysis.py: Tests of Apple Data Analysis Final.py, run
+with
+
+    python -m unittest test_apple_data_analysis
+
+from the directory holding both (and healthdb.py). The script's
+definitions are loaded without changing to its production directory.
+"""
+import os
+import runpy
+import unittest
+from unittest import mock
+
+import numpy
+import pandas
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+with mock.patch('os.chdir'):
+    analysis = runpy.run_path(os.path.join(HERE,
+                                           'Apple Data Analysis Final.py'),
+                              run_name='apple_data_analysis')
+rolling_features = analysis['rolling_features']
+
+
+class RollingFeaturesTest(unittest.TestCase):
+    def check(self, frame, column, window, span):
+        """
+        Compare the features of column over window (spanning span, as
+        pandas writes it) with those of pandas' rolling(span).
+        """
+        names = analysis['WINDOW_NAMES']
+        features = rolling_features(frame, [(column, 'X', [window],
+                                             ['sum', 'mean', 'count'])])
+        rolling = frame[column].rolling(span)
+        for (statistic, expected) in (('Sum', rolling.sum()),
+                                      ('DayAverage', rolling.mean()),
+                                      ('Count', rolling.count())):
+            name = 'X_Rolling_%s%s' % (names.get(window, window), statistic)
+            pandas.testing.assert_series_equal(
+                features[name], expected.fillna(0), check_names=False)
+
+    def test_daily_windows_match_pandas(self):
+        # nights with gaps (a missing night is not a zero) and a night
+        # whose sleep is unknown
+        days = pandas.to_datetime(['2019-01-01', '2019-01-02', '2019-01-04',
+                                   '2019-01-05', '2019-01-06', '2019-01-10',
+                                   '2019-01-11', '2019-01-12'])
+        frame = pandas.DataFrame(
+            {'SleepTime': [7.5, 6.25, numpy.nan, 8.0, 5.5, 7.0, 6.0, 9.0]},
+            index=days)
+        for window in (3, 5, 7):
+            self.check(frame, 'SleepTime', window, '%dD' % window)
+
+    def test_minute_windows_match_pandas(self):
+        minutes = pandas.date_range('2019-01-01', periods=200, freq='min')
+        minutes = minutes[numpy.arange(200) % 7 != 3]
+        values = numpy.arange(len(minutes), dtype=float) % 13
+        values[::11] = numpy.nan
+        frame = pandas.DataFrame({'HeartRate': values}, index=minutes)
+        self.check(frame, 'HeartRate', '15min', '15min')
+
+    def test_unsupported_statistic(self):
+        frame = pandas.DataFrame({'SleepTime': [1.0]},
+                                 index=pandas.to_datetime(['2019-01-01']))
+        self.assertRaises(ValueError, rolling_features, frame,
+                          [('SleepTime', 'Sleep', [3], ['median'])])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+test_apple_health_final.py: Tests of the loader of Apple Health Final.py,
+run with
+
+    python -m unittest test_apple_health_final
+
+from the directory holding both (and healthdb.py). The script's
+definitions are loaded without running its cells for the export.
+"""
+import os
+import runpy
+import shutil
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+final = runpy.run_path(os.path.join(HERE, 'Apple Health Final.py'),
+                       run_name='apple_health_final')
+
+EXPORT_XML = b'''<?xml version="1.0" encoding="UTF-8"?>
+<HealthData locale="en_US">
+ <Record type="HKQuantityTypeIdentifierHeartRate" sourceName="Watch"
+  sourceVersion="6.10" unit="count/min"
+  creationDate="2019-01-01 20:34:30 -0500"
+  startDate="2019-01-01 20:34:00 -0500"
+  endDate="2019-01-01 20:34:30 -0500" value="61"/>
+ <Record type="HKQuantityTypeIdentifierHeartRate" sourceName="Watch"
+  sourceVersion="6.10" unit="count/min"
+  creationDate="2019-01-01 20:35:30 -0500"
+  startDate="2019-01-01 20:35:00 -0500"
+  endDate="2019-01-01 20:35:30 -0500"/>
+</HealthData>
+'''
+
+
+class SQLiteMergeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp() + os.sep
+        with open(self.directory + 'export.xml', 'wb') as f:
+            f.write(EXPORT_XML)
+        final['HealthDataExtractor'](self.directory + 'export.xml',
+                                     verbose=False).extract()
+        ApplePostGre = final['ApplePostGre']
+        # the loader without the production paths of its __init__
+        self.loader = ApplePostGre.__new__(ApplePostGre)
+        self.loader.backend = 'sqlite'
+        self.loader.finalpath = self.directory
+        self.conn = final['healthdb'].connect_sqlite(self.directory
+                                                     + 'health.db')
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.directory)
+
+    def load(self, merge=True):
+        self.loader.insertFile(self.conn, 'heartrate',
+                               self.directory + 'HeartRate.csv',
+                               replace=False, merge=merge)
+        return self.conn.execute('SELECT * FROM heartrate '
+                                 'ORDER BY startDate').fetchall()
+
+    def test_same_file_twice(self):
+        rows = self.load()
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1][-1], None)
+        self.assertEqual(self.load(), rows)
+
+    def test_merge_removes_duplicates_of_appending_loads(self):
+        self.load(merge=False)
+        self.assertEqual(len(self.load(merge=False)), 4)
+        rows = self.load()
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(self.load(), rows)
+
+
+if __name__ == '__main__':
+    unittest.main()